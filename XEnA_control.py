@@ -10,29 +10,43 @@ import numpy as np
 import time as tm
 import XEnA_pi_interface as Xpi
 import XEnA_pndet_interface as Xpn
-import XEnA_tube_control
+import XEnA_scan_writer as Xsw
+import XEnA_sim
+import XEnA_tube_client as Xtc
+import XEnA_stream as Xst
 import threading
-import multiprocessing
+import functools
 import signal
 import time
 import sys
-import datetime
+from datetime import datetime
 import os
-import h5py
 
 
 R_CRYSTAL = 500. # mm
 D_SI440 = 0.960 # Angstrom
 D_SI331 = 1.246 # Angstrom
 HC = 12.398 # keV*A
+KTOE = 3.80998 # eV*A^2, E-E0 = KTOE*k^2 for a photo-electron of wave number k
+FLY_RUNUP = 0.2 # s, time allowed for the fly axis to reach constant velocity before the first bin
+FLY_POLL = 0.005 # s, position polling interval of fly scans
+FLY_READOUT = 0.05 # s, detector stop and readout time allowed between fly scan bins
+I0_WAIT = 0.2 # s, maximal wait for the tube monitor samples of the end of a counting interval
+ROI_UNITS = ('channel', 'keV')
 
 class General():
-    def __init__(self):
-        self._basedir = "D:/Data/"
+    def __init__(self, basedir="D:/Data/"):
+        self._basedir = basedir
         self._session = 'default/'
         today = datetime.now()
         self._savedir = self._basedir +today.strftime('%Y%m%d')+'/'+self._session
         self._lastscancmd = ''
+        self._flush_interval = Xsw.FLUSH_INTERVAL
+        self._I0trace = False
+        self._correction = None
+        self.rois = {} # {name: (start, end, unit)}, integrated at each scan point, see add_roi()
+        self.writer = None # AsyncScanWriter of the running scan, if any
+        self.scanmotors = (None, None)
 
     @property 
     def lastscancmd(self):
@@ -42,6 +56,56 @@ class General():
     def lastscancmd(self, value:str):
         self._lastscancmd = value
         
+    @property 
+    def flush_interval(self):
+        return self._flush_interval
+
+    @flush_interval.setter 
+    def flush_interval(self, value:int):
+        if isinstance(value, int) and value > 0:
+            self._flush_interval = value
+        else:
+            raise ValueError(f"Flush interval should be a strictly positive integer: {value}")
+
+    @property 
+    def I0trace(self):
+        return self._I0trace
+
+    @I0trace.setter 
+    def I0trace(self, value:bool):
+        # store the full tube current trace of each scan point, next to its mean and integral
+        if isinstance(value, bool):
+            self._I0trace = value
+        else:
+            raise TypeError(f"{value} is not a bool")
+
+    @property 
+    def correction(self):
+        return self._correction
+
+    @correction.setter 
+    def correction(self, value:str):
+        # store spectra corrected with this model (see Xsw.CORRECTIONS) next to the raw spectra, None for raw data only
+        if value is None or value in Xsw.CORRECTIONS:
+            self._correction = value
+        else:
+            raise ValueError(f"Unknown correction model {value}, choose from {list(Xsw.CORRECTIONS)} or None")
+
+    def add_roi(self, name:str, start:float, end:float, unit:str='channel'):
+        # start, end: first and last channel (unit='channel') or energy in keV (unit='keV') of the ROI
+        if unit not in ROI_UNITS:
+            raise ValueError(f"Unknown ROI unit {unit}, choose from {list(ROI_UNITS)}")
+        if not str(name).isidentifier():
+            raise ValueError(f"ROI name should be a single word: {name}")
+        if end < start or start < 0:
+            raise ValueError(f"ROI should have 0 <= start <= end: {start}, {end}")
+        self.rois[str(name)] = (float(start), float(end), unit)
+
+    def remove_roi(self, name:str):
+        if name not in self.rois:
+            raise KeyError(f"Key Error: Unknown ROI <{name}>")
+        del self.rois[name]
+
     @property 
     def basedir(self):
         return self._basedir
@@ -71,6 +135,7 @@ class General():
         self.savedir = self.basedir +today.strftime('%Y%m%d')+'/'+self.session
 
         print(f"Current session: {self.session}.")
+        os.makedirs(self.savedir, exist_ok=True)
         # list of directories in folder self.session that starts with 'scan'
         dirs = [item for item in os.listdir(self.savedir) if os.path.isdir(self.savedir+item) and item.startswith('scan_')]
         if dirs == []:
@@ -81,30 +146,78 @@ class General():
 
         print(f"\tNext data will be stored in {self.savedir}scan_{self.scanid:04d}/")    
 
+TRAJECTORY_CACHE_SIZE = 16 # number of energy trajectories remembered per Crystal
+DIST_MIN, DIST_MAX = 95., 366. # mm, related to physical encoder stage limits (collisions etc.)
+
 class Crystal():
     def __init__(self, dlattice=D_SI440, curvrad=R_CRYSTAL):
         self.dlattice = dlattice # in Angstrom
         self.curvrad = curvrad   # in mm
+        self._trajectories = {}  # (dlattice, curvrad, energies) -> theoretical encoder positions, see EtoTrajectory()
 
 srcx, srcr, detx = None, None, None #just defining these as None to get rid of warnings in mv(energy) code
+_acqgroup = None # Xpn.AcqGroup of the active detectors, see _acq_group()
+tube = None # Xtc.TubeClient of the tube control service, see _init()
+stream = None # Xst.StreamServer on which the scan data is published, see _init()
+STREAM_KEYS = ('motXpos', 'motYpos', 'I0', 'I0_integral', 'realtime_s', 'active_detectors', 'icr', 'ocr', 'roi', 'columns') # point data that is streamed
 dspace = Crystal()
 
 def EtoMotPos(energy, d=dspace, verbose=True):
+    # energy can be a single value or an array of energies (keV), in which case arrays are returned
+    energy = np.asarray(energy, dtype=float)
     sin_ang = HC/(2*energy*d.dlattice)
-    if -1 < sin_ang < 1: 
+    if np.all((-1 < sin_ang) & (sin_ang < 1)): 
         srcr_rad = np.arcsin(sin_ang)
         srcr_deg = (srcr_rad * 180/np.pi)-90.
         dist = d.curvrad/np.tan(srcr_rad)
         srcx_pos = 366 - dist  # these values are related to mechanical offsets of the instrument
         detx_pos = srcx_pos + 27
-        if verbose:
-            print("srcr encoder position = " + "{:.4f}".format(srcr_deg) + "\n" 
-                  + "srcx encoder position = " + "{:.4f}".format(srcx_pos) 
-                  + "\n" + "detx encoder position = " + "{:.4f}".format(detx_pos)
-                  + "\n" + "Relative distance = " + "{:.4f}".format(2*dist))
+        if energy.ndim == 0:
+            srcx_pos, detx_pos, srcr_deg, dist = float(srcx_pos), float(detx_pos), float(srcr_deg), float(dist)
+            if verbose:
+                print("srcr encoder position = " + "{:.4f}".format(srcr_deg) + "\n" 
+                      + "srcx encoder position = " + "{:.4f}".format(srcx_pos) 
+                      + "\n" + "detx encoder position = " + "{:.4f}".format(detx_pos)
+                      + "\n" + "Relative distance = " + "{:.4f}".format(2*dist))
+        elif verbose:
+            print("srcr encoder positions = " + "{:.4f} - {:.4f}".format(srcr_deg.min(), srcr_deg.max()) + "\n" 
+                  + "srcx encoder positions = " + "{:.4f} - {:.4f}".format(srcx_pos.min(), srcx_pos.max()) 
+                  + "\n" + "detx encoder positions = " + "{:.4f} - {:.4f}".format(detx_pos.min(), detx_pos.max())
+                  + "\n" + "Relative distances = " + "{:.4f} - {:.4f}".format(2*dist.min(), 2*dist.max()))
         return (srcx_pos, detx_pos, srcr_deg, dist)  #returns the theoretical positions (encoder values) of the motors
     else:
-        raise ValueError("ERROR: Unreachable energy for this crystal. Sin(theta): %s" %sin_ang)
+        raise ValueError("ERROR: Unreachable energy for this crystal. Sin(theta): %s" %sin_ang[(sin_ang <= -1) | (sin_ang >= 1)])
+
+def EtoTrajectory(energies, d=dspace, cache=True):
+    # Motor positions for a full energy trajectory, validated against the collision limits before anything moves.
+    #   The theoretical encoder positions are cached per crystal; the user-supplied offsets are added on each call.
+    energies = np.atleast_1d(np.asarray(energies, dtype=float))
+    key = (d.dlattice, d.curvrad, energies.tobytes())
+    table = d._trajectories.get(key)
+    if table is None:
+        srcx_pos, detx_pos, srcr_pos, dist = EtoMotPos(energies, d=d, verbose=False)
+        outofbounds = np.flatnonzero((dist <= DIST_MIN) | (dist >= DIST_MAX))
+        if outofbounds.size > 0:
+            raise ValueError("ERROR: moving energy out of bounds. Collision potential! Energy: %s keV, Dist: %s" 
+                             %(energies[outofbounds[0]], dist[outofbounds[0]]))
+        table = {'srcx': srcx_pos, 'detx': detx_pos, 'srcr': srcr_pos, 'dist': dist}
+        if cache:
+            if len(d._trajectories) >= TRAJECTORY_CACHE_SIZE:
+                d._trajectories.pop(next(iter(d._trajectories)))
+            d._trajectories[key] = table
+    return {'energy': energies,
+            'srcx': table['srcx']+srcx.offset,
+            'detx': table['detx']+detx.offset,
+            'srcr': table['srcr']+srcr.offset,
+            'dist': table['dist']}
+
+def _mv_trajectory(traj, i):
+    # move to point i of a trajectory obtained from EtoTrajectory()
+    try:
+        Xpi.XEnA_move_group([srcx, detx, srcr], [traj['srcx'][i], traj['detx'][i], traj['srcr'][i]])
+        _stage_by_name('energy').lastpos = float(traj['energy'][i])
+    finally:
+        Xpi.XEnA_store_dict(_stages)
 
 def MotPostoE(d=dspace): #Note: this function only provides estimate energy position, 
             #as it does not take into account the srcr or physical crystal position
@@ -129,6 +242,63 @@ def _arg_validity(*args):
     
 def newsession(name:str):
     general.session = name
+
+def _cmdstr(args):
+    # devices are represented by their uname in the scan command string
+    return ' '.join(str(arg.uname) if hasattr(arg, 'uname') else str(arg) for arg in args)
+
+_cmddepth = 0 # number of nested running commands, see _command()
+
+def _command(func):
+    # user command: a ctrl+c (Xpi.XEnA_abort) stays in effect until the command ends, also for the commands it calls
+    #   (e.g. mv within ascan), and is cleared when the next command is started from the console
+    @functools.wraps(func)
+    def command(*args, **kwargs):
+        global _cmddepth
+        if _cmddepth == 0:
+            Xpi.XEnA_abort_clear()
+        _cmddepth += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _cmddepth -= 1
+    return command
+
+def _check_abort():
+    # ends a scan between points after a ctrl+c
+    if Xpi.XEnA_aborted():
+        raise RuntimeError("ERROR: command aborted.")
+
+def _stage_by_name(uname:str):
+    for _stage in _stages:
+        if _stage.uname == uname:
+            return _stage
+    raise KeyError("Key Error: Unknown device <"+uname+">")
+
+def _scan_start(npoints:int, motX, motY, columns=(), attrs=None):
+    # open the scan file once for the whole scan; only needed when there is detector data to store
+    if any([det.connected for det in _detectors]):
+        scandir = f"{general.savedir}scan_{general.scanid:04d}/"
+        if os.path.isdir(scandir) is False:
+            os.makedirs(scandir)
+        # points are written on a separate thread, so storage overlaps with the next motor move
+        general.writer = Xsw.AsyncScanWriter(Xsw.ScanWriter(f"{scandir}scan_{general.scanid:04d}.h5", general.lastscancmd, npoints,
+                                                            motX.uname, motY.uname, flush_interval=general.flush_interval,
+                                                            columns=columns, attrs=attrs, correction=general.correction,
+                                                            rois=general.rois))
+    general.scanmotors = (motX, motY)
+    if stream is not None:
+        stream.publish('start', {'cmd': general.lastscancmd, 'scanid': general.scanid, 'npoints': npoints,
+                                 'motX': motX.uname, 'motY': motY.uname, 'attrs': attrs or {}, 'rois': general.rois})
+
+def _scan_end():
+    Xpi.XEnA_store_dict(_stages, force=True)
+    if general.writer is not None:
+        writer, general.writer = general.writer, None
+        writer.close() # waits for all queued points to be stored
+    if stream is not None:
+        stream.publish('end', {'scanid': general.scanid})
+    general.scanid += 1 #increment the scanid so next scan won't be written in same file here
    
 
 # depending on cmd_base, call different functions to execute
@@ -138,12 +308,7 @@ def wm(*args):
         syntax = "Syntax Error: Please provide a motor name.\n    wm(<name1> {, <name2>})"
         raise SyntaxError(syntax)
     
-    positions = list('')
-    for _stage in args:
-        if _stage.device is None:
-            positions.append(_stage.lastpos)
-        else:
-            positions.append(Xpi.XEnA_qpos(_stage))
+    positions = Xpi.XEnA_qpos_all(args)
     print("\n    ")
     for i in range(0, len(args), 5):
         print("    "+"".join(n.uname.center(20) for n in args[i:i+5]))
@@ -151,21 +316,42 @@ def wm(*args):
 
 def wall():
     '''Retreive the current position of all devices.\n    Syntax: wall()'''
-    _positions = list('')
-    for _stage in _stages:
-        if _stage.device is None:
-            _positions.append(_stage.lastpos)
-        else:
-            _positions.append(Xpi.XEnA_qpos(_stage))
+    _positions = Xpi.XEnA_qpos_all(_stages)
     print("\n    ")
     for i in range(0, len(_positions), 5):
         print("    "+"".join(n.uname.center(20) for n in _stages[i:i+5]))
         print("    "+"".join(str("%.4f" % pos).center(20) for pos in _positions[i:i+5])+'\n')
 
+def motionstats():
+    '''Print the measured move, settle and homing durations of all devices.\n    Syntax: motionstats()'''
+    Xpi.XEnA_motion_report(_stages)
+
+def roi(name:str, start:float, end:float, unit:str='channel'):
+    '''Define a region of interest, integrated over all active detectors for each scan point and stored as roi/<name> in the scan file (in map shape for a mesh).\n
+    start and end are the first and last channel (unit='channel') or energy in keV (unit='keV').\n
+        Syntax: roi(<name>, <start>, <end> {, unit='channel'|'keV'})'''
+    general.add_roi(name, start, end, unit=unit)
+    lsroi()
+
+def roidel(*args):
+    '''Remove regions of interest.\n    Syntax: roidel(<name1> {, <name2>})'''
+    if len(args) < 1:
+        syntax = "Syntax Error: Please provide a ROI name.\n    roidel(<name1> {, <name2>})"
+        raise SyntaxError(syntax)
+    for name in args:
+        general.remove_roi(name)
+
+def lsroi():
+    '''List the defined regions of interest.\n    Syntax: lsroi()'''
+    print("\n    "+"name".center(20)+"start".center(12)+"end".center(12)+"unit".center(10))
+    for name, (start, end, unit) in general.rois.items():
+        print("    "+name.center(20)+f"{start:g}".center(12)+f"{end:g}".center(12)+unit.center(10))
+
 def wa():
     '''Retreive the current position of all devices.\n    Syntax: wa()'''
     wall()
 
+@_command
 def home(*args):
     '''Home a motor stage to the reference position \n   Syntax: home(<name1> {,<name2>, ...})'''
     if len(args) < 1:
@@ -176,6 +362,7 @@ def home(*args):
         if _arg_validity(_stage) is True:
             Xpi.XEnA_pi_home(_stage)
     
+@_command
 def mv(*args, d=dspace): #'pos' in keV for energy, 'd' in Angstrom
     '''Move a motor stage to the defined absolute position. \n   Syntax: mv(<name1>, <pos1> {,<name2>, <pos2>})'''
     if len(args) <= 1 or len(args) % 2 != 0:
@@ -183,23 +370,33 @@ def mv(*args, d=dspace): #'pos' in keV for energy, 'd' in Angstrom
         raise SyntaxError(syntax)
 
     if _arg_validity(args[::2]) is True:
-        for _stage, _pos in np.asarray((args[::2],args[1::2])).T:
+        # collect all axis targets first, so all stages are moved simultaneously
+        _movestages, _targets = [], []
+        _energy = None
+        for _stage, _pos in zip(args[::2], args[1::2]):
             _pos = float(_pos)
             if _stage.uname == 'energy':
                 try:
-                    srcx_pos, detx_pos, srcr_pos, dist = EtoMotPos(_pos, verbose=False) #returns the theoretical encoder positions, 
-                    if 95 < dist < 366: # these values are related to physical encoder stage limits (collisions etc.)
-                        #   consider user-supplied offset for further move
-                        mv(srcx, srcx_pos+srcx.offset, detx, detx_pos+detx.offset, srcr, srcr_pos+srcr.offset, d=d)
-                        _stage.lastpos = _pos
-                    else:
-                        raise ValueError("ERROR: moving energy out of bounds. Collision potential! Dist: %s" %dist)
+                    # encoder positions including user-supplied offsets, checked against the collision limits
+                    _traj = EtoTrajectory(_pos, d=d, cache=False)
+                    _movestages += [srcx, detx, srcr]
+                    _targets += [_traj['srcx'][0], _traj['detx'][0], _traj['srcr'][0]]
+                    _energy = (_stage, _pos)
                 except ValueError as er:
                     print(er)
             else:
-                Xpi.XEnA_move(_stage, _pos)
-            Xpi.XEnA_store_dict(_stages)
-
+                _movestages.append(_stage)
+                _targets.append(_pos)
+        if len(_movestages) > 0:
+            try:
+                Xpi.XEnA_move_group(_movestages, _targets)
+                if _energy is not None:
+                    _energy[0].lastpos = _energy[1]
+            finally:
+                # positions are stored once for the whole group move, also when some axes failed
+                Xpi.XEnA_store_dict(_stages)
+
+@_command
 def mvr(*args, d=dspace):
     '''Move a motor stage to the defined relative position. \n   Syntax: mvr(<name1>, <pos1> {,<name2>, <pos2>})'''
     if len(args) <= 1 or len(args) % 2 != 0:
@@ -207,42 +404,278 @@ def mvr(*args, d=dspace):
         raise SyntaxError(syntax)
 
     if _arg_validity(args[::2]) is True:
-        for _stage, _step in np.asarray((args[::2],args[1::2])).T:
+        _moveargs = []
+        for _stage, _step in zip(args[::2], args[1::2]):
             if _stage.uname == 'energy' or _stage.uname == "dummy":
                 goto_pos = _stage.lastpos+_step
             else:
-                goto_pos = Xpi.XEnA_qpos(_stage)+_step
-            mv(_stage, goto_pos, d=d)
+                goto_pos = Xpi.XEnA_qpos(_stage, maxage=Xpi.POSCACHE_AGE)+_step
+            _moveargs += [_stage, goto_pos]
+        mv(*_moveargs, d=d)
 
 def cnt(time:float):
     '''Count for a given amount of seconds. Data will be stored for the active detectors.'''
     count(time)
 
+@_command
 def count(time:float):
     '''Count for a given amount of seconds. Data will be stored for the active detectors.'''
 
     general.lastscancmd = f"count {time}"
-    _data_acq(time)
+    _scan_start(1, _stage_by_name('energy'), _stage_by_name('detx'))
+    try:
+        _data_acq(time)
+    finally:
+        _scan_end()
     
 
+@_command
 def ascan(*args):
     '''Perform an absolute scan by moving the specified device from start pos to end pos in a discrete amount of steps, acquiring <time> seconds at each position.\n   Syntax: ascan(<name>, <start>, <end>, <nsteps>, <time>)'''
     if len(args) != 5 :
         syntax = "Syntax Error: Incorrect number of arguments.\n    ascan(<name>, <start>, <end>, <nsteps>, <time>)"
         raise SyntaxError(syntax)
     
-    general.lastscancmd = f"ascan {' '.join(args)}"
+    general.lastscancmd = f"ascan {_cmdstr(args)}"
     _stage, _start, _end, _nstep, _time = args
     if _arg_validity(_stage) is True:
         _step = (_end-_start)/_nstep
-        mv(_stage, _start)
-        for i in range(int(_nstep)+1):
+        if _stage.uname == 'energy':
+            # validate the full energy trajectory before any motor moves
+            _traj = EtoTrajectory(np.linspace(_start, _end, int(_nstep)+1))
+            _mv_trajectory(_traj, 0)
+        else:
+            mv(_stage, _start)
+        _scan_start(int(_nstep)+1, _stage, _stage)
+        try:
+            for i in range(int(_nstep)+1):
+                # measure
+                _data_acq(_time)
+                _check_abort()
+                if i < _nstep:
+                    if _stage.uname == 'energy':
+                        _mv_trajectory(_traj, i+1)
+                    else:
+                        mvr(_stage, _step)
+        finally:
+            _scan_end()
+
+def _escan_trajectory(edge, regions, time, kweight=0.):
+    # energies (keV), dwell times (s) and photo-electron wave numbers (1/A) of all escan points
+    energies, dwell = [], []
+    for region in regions:
+        if len(region) != 4:
+            raise SyntaxError("Syntax Error: an escan region is defined as (<start>, <end>, <step>, <unit>).")
+        _start, _end, _step, _unit = region
+        if _step <= 0 or _end < _start:
+            raise ValueError(f"ERROR: escan region {region} should have start <= end and a positive step.")
+        points = np.arange(_start, _end+_step/2., _step)
+        if _unit == 'eV':
+            energies.append(edge + points/1000.)
+            dwell.append(np.full(points.shape, float(time)))
+        elif _unit == 'k':
+            if _start <= 0:
+                raise ValueError(f"ERROR: k-space region {region} should start at k > 0.")
+            energies.append(edge + KTOE*points**2/1000.)
+            dwell.append(time*(points/_start)**kweight)
+        else:
+            raise ValueError(f"ERROR: unknown escan region unit '{_unit}', use 'eV' or 'k'.")
+    energies = np.concatenate(energies)
+    dwell = np.concatenate(dwell)
+
+    # regions sharing a boundary would measure that energy twice
+    keep = np.concatenate(([True], np.abs(np.diff(energies)) > 1e-9))
+    energies, dwell = energies[keep], dwell[keep]
+    if np.any(np.diff(energies) < 0):
+        raise ValueError("ERROR: escan regions should be supplied in increasing energy order.")
+    k = np.full(energies.shape, np.nan)
+    above = energies > edge
+    k[above] = np.sqrt((energies[above]-edge)*1000./KTOE)
+    return energies, dwell, k
+
+@_command
+def escan(*args, kweight=0.):
+    '''Perform an energy scan around an absorption edge in consecutive regions of different step size, acquiring at each energy.\n
+    Regions are tuples (<start>, <end>, <step>, <unit>), with unit 'eV' (relative to the edge, e.g. pre-edge and XANES)
+        or 'k' (photo-electron wave number in 1/Angstrom, EXAFS). In k regions the counting time is scaled as <time>*(k/<start>)**kweight.\n
+        Syntax: escan(<edge>, [(<start>, <end>, <step>, <unit>), ...], <time> {, kweight=<w>})'''
+    if len(args) != 3 :
+        syntax = "Syntax Error: Incorrect number of arguments.\n    escan(<edge>, [(<start>, <end>, <step>, <unit>), ...], <time> {, kweight=<w>})"
+        raise SyntaxError(syntax)
+
+    general.lastscancmd = f"escan {_cmdstr(args)} kweight={kweight}"
+    _edge, _regions, _time = args
+    _energy = _stage_by_name('energy')
+    _energies, _dwell, _k = _escan_trajectory(_edge, _regions, _time, kweight=kweight)
+    # validate the full energy trajectory before any motor moves
+    _traj = EtoTrajectory(_energies)
+    print(f"escan: {_energies.size} points from {_energies[0]:.4f} to {_energies[-1]:.4f} keV, total counting time {_dwell.sum():.1f} s.")
+    _mv_trajectory(_traj, 0)
+    _scan_start(_energies.size, _energy, _energy, columns=('energy', 'dwell_time', 'k'))
+    try:
+        for i in range(_energies.size):
             # measure
-            _data_acq(_time)
-            if i < _nstep:
-                mvr(_stage, _step)
-    general.scanid += 1 #increment the scanid so next scan won't be written in same file here
+            _data_acq(_dwell[i], columns={'energy': _energies[i], 'dwell_time': _dwell[i], 'k': _k[i]})
+            _check_abort()
+            if i < _energies.size-1:
+                _mv_trajectory(_traj, i+1)
+    finally:
+        _scan_end()
+
+def _fly_line(_stage, _start, _end, _nbins, _time, gate='time'):
+    # Move _stage once from _start to _end at constant velocity, while the detectors count _nbins consecutive bins.
+    #   The stage moves one bin width per _time+FLY_READOUT, so the detector readout is a gap between the bins instead of a drift:
+    #   with gate='time' bin b counts _time seconds from t0+b*(_time+FLY_READOUT), t0 being the moment the stage passes _start;
+    #   with gate='position' bin b starts when the stage passes edge b (or when the previous readout is done) and ends at edge b+1.
+    #   A readout that takes longer shortens the following bins; a bin without any counting time left is an error.
+    #   Positions are polled around each detector start/stop and the bin edges are interpolated from these samples.
+    if gate not in ('time', 'position'):
+        raise ValueError(f"ERROR: unknown fly scan gate '{gate}', use 'time' or 'position'.")
+    if _stage.device is None:
+        raise KeyError("Key Error: fly scans require a motorised stage: "+_stage.uname)
+    active_dets = [det for det in _detectors if det.connected is True]
+    _width = (_end-_start)/_nbins
+    _period = _time+FLY_READOUT
+    _velocity = abs(_width)/_period
+    _runup = np.sign(_width)*_velocity*FLY_RUNUP # distance to reach constant velocity before the first bin
+    _edges = _start + np.arange(_nbins+1)*_width
+    # the run-up before the first and after the last bin must remain within the stage travel
+    _travel = Xpi.XEnA_travel(_stage)
+    _low, _high = sorted((_start-_runup, _end+_runup))
+    if _travel is not None and (_low < _travel[0] or _high > _travel[1]):
+        raise ValueError(f"ERROR: fly move {_low:.4f} - {_high:.4f} (including run-up) exceeds the travel range of {_stage.uname}: {_travel[0]:.4f} - {_travel[1]:.4f}")
+
+    Xpi.XEnA_move(_stage, _start-_runup)
+    Xpi.XEnA_set_velocity(_stage, _velocity)
+    samples = [] # (timestamp, position)
+    bintimes = np.zeros((_nbins, 2))
+    records = []
+    def _sample():
+        # position with the middle of its query as timestamp
+        tquery = tm.time()
+        pos = Xpi.XEnA_qpos(_stage)
+        samples.append(((tquery+tm.time())/2, pos))
+
+    def _passed(edge, timeout):
+        # polls the stage position until it passes edge; False when it did not within timeout seconds
+        tpoll = tm.time()
+        while np.sign(_width)*(samples[-1][1]-edge) < 0:
+            if tm.time()-tpoll > timeout:
+                return False
+            tm.sleep(FLY_POLL)
+            _sample()
+        return True
+
+    readout = 0. # s, longest detector stop and readout
+    try:
+        Xpi.XEnA_move_start(_stage, _end+_runup)
+        _sample()
+        if _passed(_start, 2*FLY_RUNUP+3*_period) is False:
+            raise RuntimeError(f"ERROR: {_stage.uname} did not reach the fly scan start position {_start:.4f}")
+        t0 = samples[-1][0]
+        for b in range(_nbins):
+            # the bin starts at its scheduled time (time gate) or edge (position gate), or as soon as the previous readout is done
+            if gate == 'time':
+                tm.sleep(max(0., t0+b*_period-tm.time()))
+                if tm.time() >= t0+b*_period+_time:
+                    raise RuntimeError(f"ERROR: detector readout exceeds the fly scan bin time of {_time} s, use a longer <time>.")
+            else:
+                _sample()
+                _passed(_edges[b], 3*_period)
+                if np.sign(_width)*(samples[-1][1]-_edges[b+1]) >= 0:
+                    raise RuntimeError(f"ERROR: detector readout exceeds the fly scan bin time of {_time} s, use a longer <time>.")
+            bintimes[b,0] = tm.time()
+            for det in active_dets:
+                det.start()
+            _sample()
+            if gate == 'time':
+                tm.sleep(max(0., t0+b*_period+_time-tm.time()))
+            else:
+                _passed(_edges[b+1], 3*_period)
+            bintimes[b,1] = tm.time()
+            for det in active_dets:
+                det.stop()
+            _sample()
+            for det in active_dets:
+                det.readout()
+            records.append([det.snapshot() for det in active_dets])
+            readout = max(readout, tm.time()-bintimes[b,1])
+            _check_abort()
+        Xpi.XEnA_move_wait(_stage, _end+_runup)
+        if readout > FLY_READOUT:
+            print(f"WARNING: detector readout took up to {readout:.3f} s (FLY_READOUT: {FLY_READOUT} s), some fly scan bins were shortened.")
+    except Exception:
+        # e.g. a detector error or ctrl+c: the axis would otherwise fly on to the end of the line
+        Xpi.XEnA_halt(_stage)
+        raise
+    finally:
+        Xpi.XEnA_set_velocity(_stage, _stage.velocity)
+
+    samples = np.asarray(samples)
+    binpos = np.interp(bintimes, samples[:,0], samples[:,1])
+    return binpos, records
+
+@_command
+def fscan(*args, gate='time'):
+    '''Perform a continuous (fly) scan: the device moves at constant velocity from start pos to end pos while the detectors acquire <nbins> consecutive bins of <time> seconds.\n
+    With gate='position' bins are closed when the device passes the bin edge instead. The device moves one bin per <time>+FLY_READOUT seconds,
+        leaving time for the detector readout between the bins.\n
+        Syntax: fscan(<name>, <start>, <end>, <nbins>, <time> {, gate='time'|'position'})'''
+    if len(args) != 5 :
+        syntax = "Syntax Error: Incorrect number of arguments.\n    fscan(<name>, <start>, <end>, <nbins>, <time> {, gate='time'|'position'})"
+        raise SyntaxError(syntax)
+
+    general.lastscancmd = f"fscan {_cmdstr(args)} gate={gate}"
+    _stage, _start, _end, _nbins, _time = args
+    if _arg_validity(_stage) is True:
+        _scan_start(int(_nbins), _stage, _stage, columns=('fly_start', 'fly_end'))
+        try:
+            _fly_store(_stage, _start, _end, int(_nbins), _time, gate)
+        finally:
+            _scan_end()
+
+@_command
+def fmesh(*args, gate='time'):
+    '''Perform an absolute 2D scan with a continuous (fly) movement of the fast device along each line, acquiring <nbins2> bins of <time> seconds per line.\n
+    The first device is the slow motor, which is stepped between lines.\n
+        Syntax: fmesh(<slow1>, <start1>, <end1>, <nsteps1>, <fast2>, <start2>, <end2>, <nbins2>, <time> {, gate='time'|'position'})'''
+    if len(args) != 9 :
+        syntax = "Syntax Error: Incorrect number of arguments.\n    Syntax: fmesh(<slow1>, <start1>, <end1>, <nsteps1>, <fast2>, <start2>, <end2>, <nbins2>, <time> {, gate='time'|'position'})"
+        raise SyntaxError(syntax)
 
+    general.lastscancmd = f"fmesh {_cmdstr(args)} gate={gate}"
+    _stage1, _start1, _end1, _nstep1, _stage2, _start2, _end2, _nbins2, _time = args
+    _step1 = (_end1-_start1)/_nstep1
+    # as for mesh, index1, index2 give the place of each bin in the (nsteps1+1, nbins2) map
+    _scan_start((int(_nstep1)+1)*int(_nbins2), _stage1, _stage2, columns=('fly_start', 'fly_end', ('index1', 'i4'), ('index2', 'i4')),
+                attrs={'mesh_shape': (int(_nstep1)+1, int(_nbins2)), 'snake': False})
+    try:
+        for i in range(int(_nstep1)+1):
+            mv(_stage1, _start1+i*_step1)
+            _check_abort()
+            print("line: ",i)
+            _fly_store(_stage2, _start2, _end2, int(_nbins2), _time, gate, line=i)
+    finally:
+        _scan_end()
+
+def _fly_store(_stage, _start, _end, _nbins, _time, gate, line=None):
+    # line: map line of an fmesh, stored with the bin number as the index1, index2 columns
+    binpos, records = _fly_line(_stage, _start, _end, _nbins, _time, gate=gate)
+    if general.writer is None:
+        return
+    active_dets = [det for det in _detectors if det.connected is True]
+    motX, motY = general.scanmotors
+    for b in range(_nbins):
+        # the fly axis is stored at the bin centre, the other axis at its current position
+        _center = binpos[b].mean()
+        columns = {'fly_start': binpos[b,0], 'fly_end': binpos[b,1]}
+        if line is not None:
+            columns.update(index1=line, index2=b)
+        data = _data_record([det.uname for det in active_dets], records[b], _center if motX is _stage else motX.lastpos,
+                            _center if motY is _stage else motY.lastpos, columns=columns)
+        _data_store(data)
+
+@_command
 def dscan(*args):
     '''Perform a relative scan by moving the specified device from rel. start pos to rel. end pos in a discrete amount of steps, acquiring <time> seconds at each position.\n   Syntax: dscan(<name>, <rstart>, <rend>, <nsteps>, <time>)'''
     if len(args) != 5 :
@@ -254,55 +687,69 @@ def dscan(*args):
         if _stage.device is None:
             _current_pos = _stage.lastpos
         else:
-            _current_pos = Xpi.XEnA_qpos(_stage)
+            _current_pos = Xpi.XEnA_qpos(_stage, maxage=Xpi.POSCACHE_AGE)
         ascan(_stage, _current_pos+_rstart, _current_pos+_rend, _nstep, _time)
         # at end of dscan return to original position
         mv(_stage, _current_pos)
 
-def mesh(*args):
+def _mesh_points(start1, end1, nstep1, start2, end2, nstep2, snake=False):
+    # full point list of a mesh in acquisition order: grid indices and positions of the slow (1) and fast (2) axis
+    #   with snake every other line is traversed backwards, so the fast axis never flies back to its start
+    nstep1, nstep2 = int(nstep1), int(nstep2)
+    index1, index2 = np.divmod(np.arange((nstep1+1)*(nstep2+1)), nstep2+1)
+    if snake:
+        index2 = np.where(index1 % 2 == 1, nstep2-index2, index2)
+    pos1 = start1+index1*(end1-start1)/nstep1
+    pos2 = start2+index2*(end2-start2)/nstep2
+    return index1, index2, pos1, pos2
+
+@_command
+def mesh(*args, snake=False):
     '''Perform an absolute 2D scan by moving the specified devices from start pos to end pos in a discrete amount of steps, acquiring <time> seconds at each position.\n
-    The first device is the slow motor, i.e. this one moves least during the scan.\n
-        Syntax: mesh(<slow1>, <start1>, <end1>, <nsteps1>, <fast2>, <start2>, <end2>, <nsteps2>, <time>)'''
+    The first device is the slow motor, i.e. this one moves least during the scan. With snake=True the fast motor scans every other line in reverse.\n
+        Syntax: mesh(<slow1>, <start1>, <end1>, <nsteps1>, <fast2>, <start2>, <end2>, <nsteps2>, <time> {, snake=False|True})'''
     if len(args) != 9 :
-        syntax = "Syntax Error: Incorrect number of arguments.\n    Syntax: mesh(<slow1>, <start1>, <end1>, <nsteps1>, <fast2>, <start2>, <end2>, <nsteps2>, <time>)"
+        syntax = "Syntax Error: Incorrect number of arguments.\n    Syntax: mesh(<slow1>, <start1>, <end1>, <nsteps1>, <fast2>, <start2>, <end2>, <nsteps2>, <time> {, snake=False|True})"
         raise SyntaxError(syntax)
         
-    general.lastscancmd = f"mesh {' '.join(args)}"
+    general.lastscancmd = f"mesh {_cmdstr(args)}"+(" snake=True" if snake else "")
     _stage1, _start1, _end1, _nstep1, _stage2, _start2, _end2, _nstep2, _time = args
-    _step1 = (_end1-_start1)/_nstep1
-    _step2 = (_end2-_start2)/_nstep2
-    mv(_stage1, _start1, _stage2, _start2)
-    for i in range(int(_nstep1)+1):
-        for j in range(int(_nstep2)+1):
+    _index1, _index2, _pos1, _pos2 = _mesh_points(_start1, _end1, _nstep1, _start2, _end2, _nstep2, snake=snake)
+    mv(_stage1, _pos1[0], _stage2, _pos2[0])
+    # points are stored in acquisition order; index1, index2 give their place in the (nsteps1+1, nsteps2+1) map
+    _scan_start(_pos1.size, _stage1, _stage2, columns=(('index1', 'i4'), ('index2', 'i4')),
+                attrs={'mesh_shape': (int(_nstep1)+1, int(_nstep2)+1), 'snake': bool(snake)})
+    try:
+        for k in range(_pos1.size):
             # measure
-            print("step: ",i,j)
-            _data_acq(_time)
-            if j < _nstep2:
-                mvr(_stage1, 0, _stage2, _step2)
-            else:
-                if i < _nstep1:
-                    mv(_stage1, _start1+(i+1)*_step1, _stage2, _start2)    
-    general.scanid += 1 #increment the scanid so next scan won't be written in same file here
+            print("step: ",_index1[k],_index2[k])
+            _data_acq(_time, columns={'index1': _index1[k], 'index2': _index2[k]})
+            _check_abort()
+            if k+1 < _pos1.size:
+                # only the axes that change position are moved
+                _moveargs = []
+                if _pos1[k+1] != _pos1[k]:
+                    _moveargs += [_stage1, _pos1[k+1]]
+                if _pos2[k+1] != _pos2[k]:
+                    _moveargs += [_stage2, _pos2[k+1]]
+                if len(_moveargs) > 0:
+                    mv(*_moveargs)
+    finally:
+        _scan_end()
 
     
-def dmesh(*args):
+@_command
+def dmesh(*args, snake=False):
     '''Perform a relative 2D scan by moving the specified devices from start pos to end pos in a discrete amount of steps, acquiring <time> seconds at each position.\n
-    The first device is the slow motor, i.e. this one moves least during the scan.\n
-        Syntax: dmesh(<slow1>, <rstart1>, <rend1>, <nsteps1>, <fast2>, <rstart2>, <rend2>, <nsteps2>, <time>)'''
+    The first device is the slow motor, i.e. this one moves least during the scan. With snake=True the fast motor scans every other line in reverse.\n
+        Syntax: dmesh(<slow1>, <rstart1>, <rend1>, <nsteps1>, <fast2>, <rstart2>, <rend2>, <nsteps2>, <time> {, snake=False|True})'''
     if len(args) != 9 :
-        syntax = "Syntax Error: Incorrect number of arguments.\n    Syntax: dmesh(<slow1>, <rstart1>, <rend1>, <nsteps1>, <fast2>, <rstart2>, <rend2>, <nsteps2>, <time>)"
+        syntax = "Syntax Error: Incorrect number of arguments.\n    Syntax: dmesh(<slow1>, <rstart1>, <rend1>, <nsteps1>, <fast2>, <rstart2>, <rend2>, <nsteps2>, <time> {, snake=False|True})"
         raise SyntaxError(syntax)
 
     _stage1, _rstart1, _rend1, _nstep1, _stage2, _rstart2, _rend2, _nstep2, _time = args
-    if _stage1.device is None:
-        _current_pos1 = _stage1.lastpos
-    else:
-        _current_pos1 = Xpi.XEnA_qpos(_stage1)
-    if _stage2.device is None:
-        _current_pos2 = _stage2.lastpos
-    else:
-        _current_pos2 = Xpi.XEnA_qpos(_stage2)
-    mesh(_stage1, _current_pos1+_rstart1, _current_pos1+_rend1, _nstep1, _stage2, _current_pos2+_rstart2, _current_pos2+_rend2, _nstep2, _time)
+    _current_pos1, _current_pos2 = Xpi.XEnA_qpos_all([_stage1, _stage2], maxage=Xpi.POSCACHE_AGE)
+    mesh(_stage1, _current_pos1+_rstart1, _current_pos1+_rend1, _nstep1, _stage2, _current_pos2+_rstart2, _current_pos2+_rend2, _nstep2, _time, snake=snake)
     # at end of dscan return to original position
     mv(_stage1, _current_pos1, _stage2, _current_pos2)
     
@@ -350,118 +797,156 @@ def crystal():
         suffix =  '(D_SI331)'
     print("    The current crystal dspace is: "+"{:.4f}".format(dspace.dlattice) +" Angström. "+suffix)
 
-def _data_store(filename, data:dict):
-        if os.path.isfile(filename): #append if file exists, otherwise overwrite
-            with h5py.File(f"{general.savedir}scan_{general.scanid:04d}/scan_{general.scanid:04d}.h5", 'a') as h5:
-                h5['mot1'].resize((h5['mot1'].shape[0]+1), axis=0)
-                h5['mot1'][-1] = data['motXpos']
-                h5['mot2'].resize((h5['mot2'].shape[0]+1), axis=0)
-                h5['mot2'][-1] = data['motYpos']
-                h5['raw/I0'].resize((h5['raw/I0'].shape[0]+1), axis=0)
-                h5['raw/I0'][-1] = float(tubethread.xena_tube.field_mAmon.text())
-                h5['raw/acquisition_time'].resize((h5['raw/acquisition_time'].shape[0]+1), axis=0)
-                h5['raw/acquisition_time'][-1] = data['realtime_s']
-                for index, det in enumerate(data['active_detectors']):
-                    h5[f'raw/channel{index:02d}/spectra'].resize((h5[f'raw/channel{index:2d}/spectra'].shape[0]+1, h5[f'raw/channel{index:2d}/spectra'].shape[1]), axis=0)
-                    h5[f'raw/channel{index:02d}/spectra'][-1,:] = np.asarray(data['spe'][index])
-                    h5[f'raw/channel{index:02d}/icr'].resize((h5[f'raw/channel{index:2d}/icr'].shape[0]+1), axis=0)
-                    h5[f'raw/channel{index:02d}/icr'][-1] = data['icr'][index]
-                    h5[f'raw/channel{index:02d}/ocr'].resize((h5[f'raw/channel{index:2d}/ocr'].shape[0]+1), axis=0)
-                    h5[f'raw/channel{index:02d}/ocr'][-1] = data['ocr'][index]
-                    h5[f'raw/channel{index:02d}/sumspec'] += data['spe'][index]
-                    for chnl in range(len(data['spe'][index])):
-                        h5[f'raw/channel{index:02d}/maxspec'][chnl] = max(h5[f'raw/channel{index:2d}/spectra'][:,chnl])
-        else:
-            with h5py.File(f"{general.savedir}scan_{general.scanid:04d}/scan_{general.scanid:04d}.h5", 'w') as h5:
-                h5.create_dataset('cmd', data=data['command'])
-                h5.create_dataset('raw/I0', data=float(tubethread.xena_tube.field_mAmon.text()), compression='gzip', compression_opts=4, maxshape=(None,))
-                dset = h5.create_dataset('mot1', data=data['motXpos'], compression='gzip', compression_opts=4, chunks=True, maxshape=(None,))
-                dset.attrs['Name'] = data['motX']
-                dset = h5.create_dataset('mot2', data=data['motYpos'], compression='gzip', compression_opts=4, chunks=True, maxshape=(None,))
-                dset.attrs['Name'] = data['motY']
-                h5.create_dataset('raw/acquisition_time', data=data['realtime_s'], compression='gzip', compression_opts=4, chunks=True, maxshape=(None,)) 
-                for index, det in enumerate(data['active_detectors']):
-                    h5.create_dataset(f'raw/channel{index:02d}/spectra', data=np.asarray(data['spe'][index]), compression='gzip', compression_opts=4, chunks=True, maxshape=(None,))
-                    h5.create_dataset(f'raw/channel{index:02d}/icr', data=data['icr'][index], compression='gzip', compression_opts=4, chunks=True, maxshape=(None,))
-                    h5.create_dataset(f'raw/channel{index:02d}/ocr', data=data['ocr'][index], compression='gzip', compression_opts=4, chunks=True, maxshape=(None,))
-                    h5.create_dataset(f'raw/channel{index:02d}/sumspec', data=np.asarray(data['spe'][index]), compression='gzip', compression_opts=4, chunks=True, maxshape=(None,))
-                    h5.create_dataset(f'raw/channel{index:02d}/maxspec', data=np.asarray(data['spe'][index]), compression='gzip', compression_opts=4, chunks=True, maxshape=(None,))
-                    dset = h5[f'raw/channel{index:02d}']
-                    dset.attrs['DetName'] = det
+def _data_record(detnames, detdata, motXpos, motYpos, columns=None):
+    # point record as stored by the ScanWriter, built from the readout data dict of each detector
+    tstart = detdata[0].get('start_time', np.nan)
+    I0, I0_integral, I0_trace = _read_I0(tstart, tstart+detdata[0]['realtime_s'])
+    return {'motXpos': motXpos,
+            'motYpos': motYpos,
+            'I0' : I0,
+            'I0_integral' : I0_integral,
+            'I0_trace' : I0_trace,
+            'realtime_s' : detdata[0]['realtime_s'],  #TODO: could be that just using tm of first detector is not the best idea... see how these times differ for different detectors
+            'active_detectors' : detnames,
+            'spe' : [data['spe_cts'] for data in detdata],
+            'icr' : [data['icr_cps'] for data in detdata],
+            'ocr' : [data['ocr_cps'] for data in detdata],
+            'realtime' : [data['realtime_s'] for data in detdata],
+            'events' : [data['events_cts'] for data in detdata],
+            'roi' : _roi_values(detdata),
+            'settings' : [{key: data[key] for key in Xpn.SETTINGS} for data in detdata],
+            'columns' : columns
+            }
+
+def _roi_channels(rois:dict, gain_eV:float, nchan:int):
+    # first and last channel of each ROI as arrays, energies (keV) converted with the detector gain (eV/channel)
+    bounds = np.array([(start, end) for start, end, unit in rois.values()], dtype=float).reshape(-1, 2)
+    scale = np.array([1000./gain_eV if unit == 'keV' else 1. for start, end, unit in rois.values()])
+    channels = np.clip(np.round(bounds*scale[:,np.newaxis]).astype(int), 0, nchan-1)
+    return channels[:,0], channels[:,1]
+
+def _roi_values(detdata):
+    # counts within each ROI of general.rois, summed over the detectors; one cumulative sum per spectrum serves all ROIs
+    if len(general.rois) == 0:
+        return {}
+    values = np.zeros(len(general.rois))
+    for data in detdata:
+        first, last = _roi_channels(general.rois, data['gain_eV'], len(data['spe_cts']))
+        cumsum = np.concatenate(([0], np.cumsum(data['spe_cts'], dtype=np.int64)))
+        values += cumsum[last+1]-cumsum[first]
+    return dict(zip(general.rois, values))
+
+def _read_I0(tstart, tstop):
+    # mean (mA) and integral (mA*s) of the tube current over the counting interval [tstart, tstop] (time.time()),
+    #   and if general.I0trace the current trace as (time since tstart, mA); NaN when running without tube control
+    global tube
+    if tube is None or not np.isfinite(tstart):
+        return np.nan, np.nan, None
+    try:
+        # the monitor samples arrive in blocks, so the service waits up to I0_WAIT for the end of the interval
+        kV, mA, integral = tube.interval(tstart, tstop, timeout=I0_WAIT)
+        trace = None
+        if general.I0trace is True:
+            samples = np.asarray(tube.window(tstart, tstop))
+            trace = (samples[0]-tstart, samples[2])
+    except (EOFError, OSError, RuntimeError) as err:
+        print("WARNING: lost connection to the tube control service, I0 is no longer recorded: "+str(err))
+        tube = None
+        return np.nan, np.nan, None
+    return mA, integral, trace
+
+def _data_store(data:dict):
+    general.writer.store(data)
+    if stream is not None:
+        # never blocks: subscribers that do not keep up miss points
+        stream.publish('point', {key: data[key] for key in STREAM_KEYS}, spectra=data['spe'])
     
-def _data_acq(time):
+def _acq_group(active_dets):
+    # the acquisition threads are started once and reused for as long as the same detectors are active
+    global _acqgroup
+    if _acqgroup is None or _acqgroup.dets != active_dets:
+        if _acqgroup is not None:
+            _acqgroup.close()
+        _acqgroup = Xpn.AcqGroup(active_dets)
+    return _acqgroup
+
+def _data_acq(time, columns=None):
     if any([det.connected for det in _detectors]):
         #detectors should all be triggered simultaneously
         active_dets = [det for det in _detectors if det.connected is True]
-        procs = []
-        for _det in active_dets:
-            p = multiprocessing.Process(target=_det.acq, args=(time))
-            procs.append(p)
-            p.start()
-        #wait for all processes to end
-        for p in procs:
-            p.join()
-        #now we need to do something with the data...
-        if os.path.isdir(f"{general.savedir}scan_{general.scanid:04d}/") is False:
-            os.mkdir(general.savedir)
-        
-        #check if scan file already exists, if so append data, else create now file with maxshape=(None,)
-        cmd = general.lastscancmd.strsplit(' ')
-        if cmd[1] != 'count':
-            mot1 = cmd[1]
-            if len(cmd) > 6:
-                mot2 = cmd[5]
-            else:
-                mot2 = mot1
-        else:
-            mot1 = 'energy'
-            mot2 = 'detx'
-            
-        data = {'command' : general.lastscancmd,
-                'motXpos': exec(f"{mot1}.lastpos"),
-                'motYpos': exec(f"{mot2}.lastpos"),
-                'motX' : mot1,
-                'motY' : mot2,
-                'realtime_s' : active_dets[0].data['realtime_s'],  #TODO: could be that just using tm of first detector is not the best idea... see how these times differ for different detectors
-                'active_detectors' : [det.uname for det in active_dets],
-                'spe' : [det.data['spe_cts'] for det in active_dets],
-                'icr' : [det.data['icr'] for det in active_dets],
-                'ocr' : [det.data['ocr'] for det in active_dets]
-                }
-        _data_store(f"{general.savedir}scan_{general.scanid:04d}/scan_{general.scanid:04d}.h5", data)
+        _acq_group(active_dets).acq(time)
+
+        motX, motY = general.scanmotors
+        _data_store(_data_record([det.uname for det in active_dets], [det.snapshot() for det in active_dets], motX.lastpos, motY.lastpos, columns))
         
     else:
         tm.sleep(time)
 
-def _handle_ctrlc():
+def _handle_ctrlc(signum=None, frame=None):
     print("ctrl+c event registered")
+    Xpi.XEnA_abort() # halts the axes that are moving and ends the running command
     
-def _handle_exit():
+def _handle_exit(signum=None, frame=None):
     print("Shutting down XEnA...")
+    # store the queued points and close the file of an interrupted scan so its data remains readable
+    if general.writer is not None:
+        writer, general.writer = general.writer, None
+        try:
+            writer.close()
+        except Exception as err:
+            print(err)
+    if _acqgroup is not None:
+        _acqgroup.close()
+    # the tube control service keeps running, only the connection is closed
+    if tube is not None:
+        tube.close()
+    if stream is not None:
+        stream.close()
     # disconnecting stages
     Xpi.XEnA_close(_stages)
     # let's hold for 10seconds and then close all the rest.
     time.sleep(10)
     sys.exit()
 
-if __name__ == "__main__":
-    #start tube control window spawn
-    tubethread = XEnA_tube_control.RunTubeGui()
-    tubethread.start()
+def _init(basedir="D:/Data/", tubegui=True, tube=True, stream=True):
+    # connect all hardware and define a variable for each device uname, so devices can be used by name in the commands
+    #   tube: connect to (and if needed start) the tube control service for I0; tubegui: open the tube control window
+    #   stream: publish the scan data on the live stream (XEnA_stream)
+    global _stages, _detectors, general
+    _myVars = globals()
+    if tube is True:
+        try:
+            _myVars['tube'] = Xtc.connect(start=True)
+        except Exception as err:
+            print("WARNING: no connection to the tube control service, I0 is not recorded: "+str(err))
+    if tubegui is True:
+        #start tube control window spawn, a separate process
+        Xtc.start_gui()
+    if stream is True:
+        try:
+            _myVars['stream'] = Xst.StreamServer()
+        except OSError as err:
+            print("WARNING: the scan data is not streamed: "+str(err))
 
     # initiate PI devices and generate local variables for each device uname
     _stages = Xpi.XEnA_pi_init()
-    _myVars = locals()
     for dev in _stages:
         _myVars[dev.uname] = dev
-    _detectors = Xpn.PNDet() # for now we only have 1 detector that we would incorporate as such, so no need to specify a list etc.
-    if _detectors.connected is True:
-        _myVars[_detectors.uname] = _detectors
+    _detectors = [Xpn.PNDet()] # for now we only have 1 detector, but _data_acq handles a list of them
+    for det in _detectors:
+        if det.connected is True:
+            _myVars[det.uname] = det
     
     # Initialise data storage
-    general = General()
+    general = General(basedir=basedir)
     newsession('test') # create an initial new session 'test' so data (if any) will be stored in some sensical location
 
+if __name__ == "__main__":
+    if XEnA_sim.SIMULATE is True:
+        # simulated hardware: runs headless, without the tube control window unless configured
+        _init(basedir=XEnA_sim.CONFIG['basedir'], tubegui=XEnA_sim.CONFIG['tube_gui'])
+    else:
+        _init()
 
     signal.signal(signal.SIGTERM, _handle_exit)
     signal.signal(signal.SIGINT, _handle_ctrlc) #stop motors
@@ -5,20 +5,42 @@ Created on Mon Aug 19 09:48:43 2019
 @author: prrta
 """
 
-from pipython import GCSDevice, pitools, GCSError #see PIPython-1.3.4.17/docs/html/a00009.html
+import XEnA_sim
+if XEnA_sim.SIMULATE is True:
+    from XEnA_sim import GCSDevice, GCSError
+else:
+    from pipython import GCSDevice, GCSError #see PIPython-1.3.4.17/docs/html/a00009.html
+from concurrent.futures import ThreadPoolExecutor
 import json
+import os
 import sys
+import threading
+import time
 
 STAGES = ('M-414.3PD',)  # connect stages to axes
 REFMODE = ('FNL',)  # reference the connected stages
 
+INIT_TIMEOUT = 300. # s, maximal time to connect and home a single stage at startup
+HOME_TIMEOUT = 240. # s, maximal duration of a reference move
+MOVE_TIMEOUT = 120. # s, maximal duration of a move (including settling on target)
+WAIT_POLL = 0.01 # s, initial poll interval while waiting for motion to finish
+WAIT_POLL_MAX = 0.2 # s, the poll interval grows by WAIT_BACKOFF up to this value
+WAIT_BACKOFF = 1.5
+STORE_INTERVAL = 10. # s, minimal interval between rewrites of the stage dictionary file, see XEnA_store_dict
+POSCACHE_AGE = 2. # s, positions cached after a completed move are reused for this long (see XEnA_qpos); 0 disables the cache
+_poscache = {} # uname: (encoder position, time of caching)
+_abort = threading.Event() # set by XEnA_abort() to stop the running command, cleared by XEnA_abort_clear() when the next one starts
+motion_stats = {} # uname: measured durations of the motions of each stage, see _record_motion()
+_store_lock = threading.Lock()
+_last_store = {} # outfile: time of the last full write
+
 # CONTROLLERNAME = 'C-884.DB'  # 'C-884' will also work
 # STAGES = ('M-111.1DG', 'M-111.1DG', 'NOSTAGE', 'NOSTAGE')
 # REFMODE = ('FNL', 'FNL')
 
 class Pidevice():
     """Connect to a PIPython device."""
-    def __init__(self, stagedict):
+    def __init__(self, stagedict, connect=True):
         # We recommend to use GCSDevice as context manager with "with".
         # InterfaceSetupDlg() is an interactive dialog. There are other
         # methods to connect to an interface without user interaction.
@@ -37,6 +59,7 @@ class Pidevice():
                 self.velocity = None
                 self.offset = 0
                 self.referenced = False
+                self.homegroup = None
         else:
             if stagedict['uname'] == 'dummy' or stagedict['uname'] == 'energy':
                 self.device = None
@@ -48,78 +71,197 @@ class Pidevice():
                 self.velocity = None
                 self.offset = float(stagedict['offset'])
                 self.referenced = stagedict['referenced']
+                self.homegroup = None
             else:
-                print("")
-                print("Connecting "+stagedict['uname']+"...")
-                print("    Serial: ",stagedict['usb'], "controller: ", stagedict['controller'], "stage: ", stagedict['stage'])
-                try:
-                    self.device = GCSDevice(stagedict['controller'])
-                    self.device.ConnectUSB(serialnum=stagedict['usb'])
-                    print("    Switching on servo...", end="")
-                    self.device.SVO(self.device.axes, values=True) # switches on servo
-                    print(" done.")
-                    if stagedict['referenced'] == False: #The case if we don't want to work with referenced stages
-                        print("    Setting reference state to False...", end="")
-                        self.device.RON(self.device.axes,values=False)
-                        print(" done.")
-                    else: #However, if they are to be referenced, we should home them now
-                        print("    Homing device...", end="")
-                        _pi_home(self)
-                        print(" done.")
-                        print("    Moving stage to last known position...", end="")
-                        self.device.MOV(self.device.axes, stagedict["lastpos"])
-                        print(" done.")
-                    print("    Setting velocity to "+ str(stagedict['velocity']), end="")
-                    self.device.VEL(self.device.axes, values=stagedict['velocity'])
-                    print(" done.")
-                    print('Connected: {}'.format(self.device.qIDN().strip()))
-                
-                    self.uname = stagedict['uname']
-                    self.usb = stagedict['usb']
-                    self.stage = stagedict['stage']
-                    self.controller = stagedict['controller']
-                    self.lastpos = float(stagedict['lastpos'])
-                    self.velocity = float(stagedict['velocity'])       
-                    self.offset = float(stagedict['offset'])
-                    self.referenced = stagedict['referenced']
-                except Exception as exc:
-                    print("Error:", exc)
-                    print("  Device not initialised: "+ stagedict['uname'])
-                    self.device = None
-                    self.uname = stagedict['uname']
-                    self.usb = stagedict['usb']
-                    self.stage = stagedict['stage']
-                    self.controller = stagedict['controller']
-                    self.lastpos = float(stagedict['lastpos'])
-                    self.velocity = float(stagedict['velocity'])      
-                    self.offset = float(stagedict['offset'])
-                    self.referenced = stagedict['referenced']
+                self.device = None
+                self.uname = stagedict['uname']
+                self.usb = stagedict['usb']
+                self.stage = stagedict['stage']
+                self.controller = stagedict['controller']
+                self.lastpos = float(stagedict['lastpos'])
+                self.velocity = float(stagedict['velocity'])       
+                self.offset = float(stagedict['offset'])
+                self.referenced = stagedict['referenced']
+                self.homegroup = stagedict.get('homegroup')
+                if connect is True:
+                    self._connect(stagedict)
+
+    def _connect(self, stagedict):
+        # stages can be connected in parallel (see XEnA_pi_init), so each message is a single line labeled with the uname
+        print("Connecting "+self.uname+"...    Serial: "+str(self.usb)+", controller: "+str(self.controller)+", stage: "+str(self.stage))
+        try:
+            self.device = GCSDevice(stagedict['controller'])
+            self.device.ConnectUSB(serialnum=stagedict['usb'])
+            self.device.SVO(self.device.axes, values=True) # switches on servo
+            print("    "+self.uname+": servo switched on.")
+            if stagedict['referenced'] == False: #The case if we don't want to work with referenced stages
+                self.device.RON(self.device.axes,values=False)
+                print("    "+self.uname+": reference state set to False.")
+            else: #However, if they are to be referenced, we should home them now
+                print("    "+self.uname+": homing device...")
+                _pi_home(self)
+                print("    "+self.uname+": homed, moving stage to last known position...")
+                self.device.MOV(self.device.axes, stagedict["lastpos"])
+                # the return move is part of the initialisation, so the next stage of a homegroup only starts once it ended
+                _wait_on_target(self, timeout=MOVE_TIMEOUT)
+            self.device.VEL(self.device.axes, values=stagedict['velocity'])
+            print("    "+self.uname+": velocity set to "+ str(stagedict['velocity']))
+            print('Connected '+self.uname+': {}'.format(self.device.qIDN().strip()))
+        except Exception as exc:
+            print("Error:", exc)
+            print("  Device not initialised: "+ stagedict['uname'])
+            self.device = None
                     
 
 
-def XEnA_pi_init():
-    stages = list('')
-    # go through stagedict and initiate each stage
-    stagedict = XEnA_read_dict('lib/stages.json')
-    for stage in stagedict:
-        stages.append(Pidevice(stage))
+def XEnA_pi_init(timeout=INIT_TIMEOUT, dictfile='lib/stages.json'):
+    # Stages are on separate controllers and are initialised in parallel, except for stages sharing a 'homegroup' in
+    #   the stage dictionary: these could collide when homed simultaneously and are initialised one after the other.
+    #   A stage that is not initialised within timeout seconds, or that waits longer than timeout seconds for the other
+    #   stages of its homegroup, is left unconnected.
+    stagedict = XEnA_read_dict(dictfile)
+    groups = {}
+    for index, stage in enumerate(stagedict):
+        groups.setdefault(stage.get('homegroup') or index, threading.Lock())
+    started = {}
+
+    def init_stage(index):
+        group = groups[stagedict[index].get('homegroup') or index]
+        if not group.acquire(timeout=timeout): # e.g. a stage of the same homegroup that hangs
+            raise TimeoutError("homegroup "+str(stagedict[index].get('homegroup'))+" still busy after %.0f s." %timeout)
+        try:
+            started[index] = time.monotonic()
+            stage = Pidevice(stagedict[index])
+            if stage.device is not None:
+                print(stage.uname+" initialised in %.1f s." %(time.monotonic()-started[index]))
+            return stage
+        finally:
+            group.release()
+
+    def close_late(future):
+        # a stage that timed out but still connected afterwards releases its controller again
+        if future.exception() is None and future.result().device is not None:
+            print("Closing connection of late stage "+future.result().uname+".")
+            future.result().device.CloseConnection()
+
+    t0 = time.monotonic()
+    print("Initialising %i stages..." %len(stagedict))
+    stages = [None]*len(stagedict)
+    pool = ThreadPoolExecutor(max_workers=len(stagedict))
+    futures = [pool.submit(init_stage, index) for index in range(len(stagedict))]
+    pending = list(range(len(stagedict)))
+    while len(pending) > 0:
+        for index in list(pending):
+            if futures[index].done():
+                try:
+                    stages[index] = futures[index].result()
+                except Exception as exc:
+                    print("Error:", exc)
+                    print("  Device not initialised: "+ stagedict[index]['uname'])
+                    stages[index] = Pidevice(stagedict[index], connect=False)
+                pending.remove(index)
+            elif index in started and time.monotonic()-started[index] > timeout:
+                print("Error: initialisation of "+stagedict[index]['uname']+" timed out after %.0f s." %timeout)
+                print("  Device not initialised: "+ stagedict[index]['uname'])
+                stages[index] = Pidevice(stagedict[index], connect=False)
+                futures[index].add_done_callback(close_late)
+                pending.remove(index)
+        time.sleep(0.05)
+    pool.shutdown(wait=False)
+    print("Stage initialisation done in %.1f s." %(time.monotonic()-t0))
 
     return stages
 
 def _pi_home(stage):
+    _poscache.pop(stage.uname, None)
     if stage.device.HasFRF(): #stupid thing where HasFRF() returns True even though it's not supported by certain stages
         try:
             stage.device.FRF()
         except GCSError:
             stage.device.FPL()
-    while True:
-        if (stage.device.IsControllerReady()):
-            break
+    duration = XEnA_wait(stage, stage.device.IsControllerReady, timeout=HOME_TIMEOUT)
+    _record_motion(stage, 'home_s', duration)
+
+def XEnA_abort():
+    # stop the motion that is currently being waited for (e.g. on ctrl+c); no new motion starts until XEnA_abort_clear()
+    _abort.set()
+
+def XEnA_abort_clear():
+    # at the start of a command: an abort request only applies to the command running at that time
+    _abort.clear()
+
+def XEnA_aborted():
+    return _abort.is_set()
+
+def _check_abort():
+    if _abort.is_set():
+        raise RuntimeError("ERROR: motion aborted.")
+
+def _halt(stage):
+    try:
+        stage.device.HLT(stage.device.axes)
+    except Exception as exc:
+        print("Error halting "+stage.uname+":", exc)
+
+def XEnA_halt(stage):
+    # stop the motion of a stage, e.g. a fly move that has to end early
+    _check_movable(stage)
+    _halt(stage)
+    _poscache.pop(stage.uname, None)
+
+def XEnA_wait(stage, ready, timeout=MOVE_TIMEOUT, poll=WAIT_POLL, maxpoll=WAIT_POLL_MAX, backoff=WAIT_BACKOFF, abort=None):
+    # Wait for ready() to return True, without spinning: the poll interval starts at poll and grows by backoff up to maxpoll.
+    #   The stage is halted when the wait times out, or is aborted through XEnA_abort() or the optional abort() callable.
+    #   Returns the duration of the wait in s.
+    t0 = time.monotonic()
+    interval = poll
+    while not ready():
+        if _abort.is_set() or (abort is not None and abort()):
+            _halt(stage)
+            raise RuntimeError("ERROR: motion of "+stage.uname+" aborted.")
+        elapsed = time.monotonic()-t0
+        if elapsed > timeout:
+            _halt(stage)
+            raise TimeoutError("ERROR: motion of "+stage.uname+" did not finish within %.0f s." %timeout)
+        _abort.wait(min(interval, timeout-elapsed))
+        interval = min(interval*backoff, maxpoll)
+    return time.monotonic()-t0
+
+def _wait_on_target(stage, timeout=MOVE_TIMEOUT, abort=None):
+    # the move phase ends when the axis stops moving, the settle phase when it is reported on target
+    t0 = time.monotonic()
+    move = XEnA_wait(stage, lambda: not any(stage.device.IsMoving(stage.device.axes).values()), timeout=timeout, abort=abort)
+    settle = XEnA_wait(stage, lambda: all(stage.device.qONT(stage.device.axes).values()), timeout=timeout-(time.monotonic()-t0), abort=abort)
+    _record_motion(stage, 'move_s', move)
+    _record_motion(stage, 'settle_s', settle)
+
+def _record_motion(stage, key, duration):
+    stats = motion_stats.setdefault(stage.uname, {})
+    n, total, maximum = stats.get(key, (0, 0., 0.))
+    stats[key] = (n+1, total+duration, max(maximum, duration))
+    stats['last_'+key] = duration
+
+def XEnA_motion_report(stages):
+    # print the number, mean and maximal duration of the moves, settling and homing of each stage
+    print("    "+"".join(s.center(14) for s in ('device', 'moves', 'move [s]', 'max [s]', 'settle [s]', 'max [s]', 'home [s]')))
+    for stage in stages:
+        stats = motion_stats.get(stage.uname)
+        if stats is None:
+            continue
+        line = [stage.uname]
+        n, total, maximum = stats.get('move_s', (0, 0., 0.))
+        line += [str(n), "%.3f" %(total/max(n, 1)), "%.3f" %maximum]
+        n, total, maximum = stats.get('settle_s', (0, 0., 0.))
+        line += ["%.3f" %(total/max(n, 1)), "%.3f" %maximum]
+        n, total, maximum = stats.get('home_s', (0, 0., 0.))
+        line += ["%.1f" %(total/n) if n > 0 else "-"]
+        print("    "+"".join(s.center(14) for s in line))
     
 
 def XEnA_pi_home(stages):    # home motors if referenced
     if type(stages) != type(list()):
         stages = [stages]
+    _check_abort()
     for stage in stages:
         if stage.device is not None: 
             if stage.device.qRON(stage.device.axes).get("1") == True:
@@ -147,18 +289,42 @@ def XEnA_pi_home(stages):    # home motors if referenced
                 else:
                     sys.stdout.write("Please respond with 'yes' or 'no' " "(or 'y' or 'n').\n")
                     
-def XEnA_qpos(stage):
-    return float(stage.device.qPOS(stage.device.axes).get("1"))+stage.offset
+def XEnA_qpos(stage, maxage=0.):
+    # with maxage > 0 a cached position of at most maxage seconds old is returned instead of querying the controller
+    if maxage > 0:
+        cached = _poscache.get(stage.uname)
+        if cached is not None and time.monotonic()-cached[1] <= maxage:
+            return cached[0]+stage.offset
+    pos = float(stage.device.qPOS(stage.device.axes).get("1"))
+    _poscache[stage.uname] = (pos, time.monotonic())
+    return pos+stage.offset
+
+def XEnA_qpos_all(stages, maxage=0.):
+    # query all controllers at once; devices that are not connected return their lastpos
+    connected = [stage for stage in stages if stage.device is not None]
+    positions = {}
+    if len(connected) > 0:
+        with ThreadPoolExecutor(max_workers=len(connected)) as pool:
+            for stage, pos in zip(connected, pool.map(lambda stage: XEnA_qpos(stage, maxage=maxage), connected)):
+                positions[stage.uname] = pos
+    return [positions[stage.uname] if stage.device is not None else stage.lastpos for stage in stages]
+
+def _poscache_set(stage, target):
+    # a completed move leaves the controller target at the requested position
+    _poscache[stage.uname] = (target-stage.offset, time.monotonic())
 
 def XEnA_close(stages):
     print("Disconnecting stages...", end="")
     for stage in stages:
-        stage.device.CloseConnection()
+        if stage.device is not None:
+            stage.device.CloseConnection()
     print(" done.")
-    XEnA_store_dict(stages) 
+    XEnA_store_dict(stages, force=True) 
 
 
-def XEnA_store_dict(stages, outfile='lib/stages.json'):
+def XEnA_store_dict(stages, outfile='lib/stages.json', force=False):
+    # Each call appends the current positions and offsets to a journal next to outfile, which is cheap and survives a crash.
+    #   The full stage dictionary is only rewritten (atomically) every STORE_INTERVAL s, or when force is True (scan end, exit).
     stagedict = list('')
     for stage in stages:
         stagedict.append({
@@ -169,36 +335,124 @@ def XEnA_store_dict(stages, outfile='lib/stages.json'):
             'offset' : stage.offset,
             'velocity' : stage.velocity,
             'referenced': stage.referenced,
+            'homegroup': stage.homegroup,
             'uname': stage.uname})
 
-    with open(outfile, 'w+') as error:
-        json.dump(stagedict, error)
+    with _store_lock:
+        # the journal is written first: whatever happens to the dictionary file, its last line is the latest state
+        with open(outfile+'.journal', 'a', encoding='utf-8') as journal:
+            journal.write(json.dumps({'time': time.time(),
+                                      'stages': {stage['uname']: [stage['lastpos'], stage['offset']] for stage in stagedict}})+'\n')
+        now = time.monotonic()
+        if force is True or now-_last_store.get(outfile, -STORE_INTERVAL) >= STORE_INTERVAL:
+            with open(outfile+'.tmp', 'w', encoding='utf-8') as tmpfile:
+                json.dump(stagedict, tmpfile)
+                tmpfile.flush()
+                os.fsync(tmpfile.fileno())
+            os.replace(outfile+'.tmp', outfile)
+            os.remove(outfile+'.journal')
+            _last_store[outfile] = now
         
 def XEnA_read_dict(dictfile):
     with open(dictfile, encoding='utf-8') as data_file:
        stagedict = json.loads(data_file.read())
+    # a journal that is left behind means XEnA was not shut down properly: its last complete line holds the latest state
+    if os.path.isfile(dictfile+'.journal'):
+        state = None
+        with open(dictfile+'.journal', encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    state = json.loads(line)['stages']
+                except (ValueError, KeyError):
+                    pass # incomplete line written during a crash
+        if state is not None:
+            print("Recovering last known stage positions from "+dictfile+".journal")
+            for stage in stagedict:
+                if stage['uname'] in state:
+                    stage['lastpos'], stage['offset'] = state[stage['uname']]
     return stagedict
 
-def XEnA_move(stage, target):
-    #pretended as an absolute move, but under the hood is a relative move to allow for movement of unreferenced stages
+def _check_movable(stage):
     if type(stage) != type(Pidevice('dummy')):
-        syntax = "Type Error: Unknown device type <"+type(stage)+">"
+        syntax = "Type Error: Unknown device type <"+str(type(stage))+">"
         raise TypeError(syntax)
         
     if stage.device is None:
         syntax = "Key Error: device not appropriately initialised: "+stage.uname
         raise KeyError(syntax)
 
-    if stage.uname == 'dummy':
-        stage.lastpos = target
-    else:
-        # move motors in relative step to allow for unreferenced motor movement.
-        rmove = target - XEnA_qpos(stage)
-        stage.device.MVR(stage.device.axes, rmove)
-        pitools.waitontarget(stage.device, axes=stage.device.axes)
-        stage.lastpos = target
+def XEnA_move(stage, target):
+    #pretended as an absolute move, but under the hood is a relative move to allow for movement of unreferenced stages
+    XEnA_move_group([stage], [target])
+
+def XEnA_move_start(stage, target):
+    # start a (relative) move without waiting for it to finish, follow up with XEnA_move_wait()
+    _check_movable(stage)
+    _check_abort()
+    rmove = target - XEnA_qpos(stage, maxage=POSCACHE_AGE)
+    _poscache.pop(stage.uname, None)
+    stage.device.MVR(stage.device.axes, rmove)
+
+def XEnA_move_wait(stage, target, timeout=MOVE_TIMEOUT):
+    _wait_on_target(stage, timeout=timeout)
+    stage.lastpos = target
+    _poscache_set(stage, target)
 
+def XEnA_travel(stage):
+    # travel range (min, max) of a referenced stage, in the coordinates of XEnA_qpos. None for a stage that is not
+    #   referenced: its controller limits are not related to the actual stage position
+    _check_movable(stage)
+    if stage.referenced is not True:
+        return None
+    low = float(stage.device.qTMN(stage.device.axes).get("1"))
+    high = float(stage.device.qTMX(stage.device.axes).get("1"))
+    return low+stage.offset, high+stage.offset
+
+def XEnA_set_velocity(stage, velocity):
+    # temporary velocity change (e.g. fly scans), stage.velocity keeps the configured value
+    _check_movable(stage)
+    stage.device.VEL(stage.device.axes, values=velocity)
+
+def XEnA_move_group(stages, targets):
+    # All stages are on separate controllers: send all targets first and only then wait for all axes together,
+    #   so the total move takes as long as the slowest axis.
+    for stage in stages:
+        _check_movable(stage)
+    unames = [stage.uname for stage in stages]
+    if len(set(unames)) != len(unames):
+        raise ValueError("ERROR: a device can only be moved once in a single move: "+", ".join(unames))
+
+    _check_abort()
+    errors = {}
+    moving = []
+    for stage, target in zip(stages, targets):
+        if stage.uname == 'dummy':
+            stage.lastpos = target
+            continue
+        try:
+            # move motors in relative step to allow for unreferenced motor movement.
+            rmove = target - XEnA_qpos(stage, maxage=POSCACHE_AGE)
+            _poscache.pop(stage.uname, None)
+            stage.device.MVR(stage.device.axes, rmove)
+            moving.append((stage, target))
+        except Exception as exc:
+            errors[stage.uname] = exc
+
+    if len(moving) > 0:
+        with ThreadPoolExecutor(max_workers=len(moving)) as pool:
+            waits = [(stage, target, pool.submit(_wait_on_target, stage)) for stage, target in moving]
+            for stage, target, wait in waits:
+                try:
+                    wait.result()
+                    stage.lastpos = target
+                    _poscache_set(stage, target)
+                except Exception as exc:
+                    errors[stage.uname] = exc
 
+    if len(errors) > 0:
+        for uname, exc in errors.items():
+            print("Error moving "+uname+":", exc)
+        raise RuntimeError("ERROR: move failed for device(s) "+", ".join(errors.keys()))
 
 
 #Useful commands:
@@ -235,6 +489,7 @@ def XEnA_move(stage, target):
 #       'offset' : 0,
 #       'velocity' : 10,
 #       'referenced' : True,
+#       'homegroup': "srcdet",  #NOTE: stages sharing a homegroup are never initialised (homed) simultaneously, see XEnA_pi_init()
 #       'uname': "srcx"},
     
 #     {'controller': "C-863.11",
@@ -244,6 +499,7 @@ def XEnA_move(stage, target):
 #       'offset' : 0,
 #       'velocity' : 10,
 #       'referenced' : True,
+#       'homegroup': "srcdet",
 #       'uname': "detx"},
     
 #     {'controller': "C-663.11",
@@ -12,14 +12,31 @@ Additionally, install the xia_microdxp_api_v2_2023.xia_microdxp_api_v2_2023 libr
 """
 
 import time
+import threading
+import numpy as np
+import XEnA_sim
+
+SETTINGS = ('nchannels', 'gain_eV', 'peakingtime_us') # detector settings that are part of the readout data
+PRESET_NONE = 0. # Handel 'preset_type' values: free running
+PRESET_REALTIME = 1. #      fixed real time, the DPP ends the run itself after 'preset_value' seconds
+RUN_POLL = 0.002 # s, poll interval while waiting for the end of a preset run
+RUN_TIMEOUT = 1. # s, time allowed on top of the preset real time for the run to end
+
+def _dpp_api():
+    # the simulated DPP (see XEnA_sim) is used when simulation is switched on
+    if XEnA_sim.SIMULATE is True:
+        return XEnA_sim
+    import xia_microdxp_api_v2_2023.xia_microdxp_api_v2_2023 as dpp_api
+    return dpp_api
 
 class PNDet():
-    def __init__(self):
-        import xia_microdxp_api_v2_2023.xia_microdxp_api_v2_2023 as dpp_api
+    def __init__(self, channel:int=0):
+        dpp_api = _dpp_api()
 
         # when multiple detectors will be used it is best to read this info from an external library or such
         self._type = 'PNDetector'
-        self._uname = "XiaDet0"
+        self._channel = int(channel)
+        self._uname = f"XiaDet{self._channel}"
         
         dpp_api.init_xia_systems()  # Initialize XIA Systems only for microDXP
         print("")
@@ -27,16 +44,27 @@ class PNDet():
         print(f"Number of active DPPs {dpp_api.number_of_detectors()}")
         print(f"XIA DPP version {dpp_api.xia_get_version_info()}")
 
+        self._spectrum = np.zeros(0, dtype=np.uint32) # preallocated readout buffer, see readout()
+        self._preset = None # real time currently programmed in the DPP (None: free running)
+        self._requested = None # real time requested by start_async()
+        self._tstart = 0.
+        self._starttime = np.nan # time.time() at the start of the last run
+        self._active = False # a run was started and not stopped yet
         try:
-            self._device = dpp_api.XiaMicroDXP(0)  # Create an instance with channel 0
+            self._device = dpp_api.XiaMicroDXP(self._channel)  # Create an instance on the given DPP channel
             print(f"Connected to dpp {self._uname}, serial nr {self._device.simple_get_serial_number()}")
+            self.refresh_settings()
+            # preset runs require the acquisition value and run data calls of the api, otherwise acq() is software timed
+            self._hwpreset = hasattr(self._device, 'set_acquisition_value') and hasattr(self._device, 'get_run_data')
+            if self._hwpreset is False:
+                print(f"    {self._uname}: no preset run support in the DPP api, acquisition is software timed.")
             self._connected = True
         except Exception as err:
             self._connected = False
             raise err
 
     def __del__(self):
-        import xia_microdxp_api_v2_2023.xia_microdxp_api_v2_2023 as dpp_api
+        dpp_api = _dpp_api()
 
         ID = self._device.simple_get_serial_number()
         dpp_api.deinit_xia_systems()
@@ -57,9 +85,24 @@ class PNDet():
     def name(self):
         return self._uname
 
+    @property 
+    def uname(self):
+        return self._uname
+
     @property 
     def gain(self):
-        return self._device.get_gain()
+        return self._settings['gain_eV']
+
+    @property 
+    def settings(self):
+        return dict(self._settings)
+
+    def refresh_settings(self):
+        # The settings are only read from the DPP at connection and after a setter changed them,
+        #   all other uses (e.g. readout) work on this snapshot.
+        self._settings = {'nchannels' : self._device.get_mca_length(),
+                          'gain_eV' : self._device.get_gain(),
+                          'peakingtime_us' : self._device.simple_get_all_setting()['selected_peaking_time']}
 
     @property
     def type(self):
@@ -67,19 +110,20 @@ class PNDet():
     
     @property
     def nchan(self):
-        return self._device.get_mca_length()
+        return self._settings['nchannels']
     
     @nchan.setter
     def nchan(self, value:int):
         valid_values = [256, 512, 1024, 2048, 4096, 8192]
         if value in valid_values and isinstance(value, int):
             self._device.set_number_mca_channels(value)
+            self.refresh_settings()
         else:
             raise TypeError(f"Select an integer value from {valid_values}")
             
     @property
     def peakingtime(self):
-        return self._device.simple_get_all_setting()['selected_peaking_time']
+        return self._settings['peakingtime_us']
     
     @peakingtime.setter 
     def peakingtime(self, value:float):
@@ -87,38 +131,158 @@ class PNDet():
             2.4, 3.2, 4.0, 4.8, 6.4, 8.0, 9.6, 12.8, 16.0, 19.2, 24.0]
         if value in valid_values and isinstance(value, float):
             self._device.simple_set_peaking_time(value)
+            self.refresh_settings()
         else:
             raise TypeError(f": Select a float value from {valid_values}")
 
+    def _set_preset(self, realtime):
+        # only changed settings are sent to the DPP
+        if self._hwpreset is True and realtime != self._preset:
+            if realtime is None:
+                self._device.set_acquisition_value('preset_type', PRESET_NONE)
+            else:
+                self._device.set_acquisition_value('preset_type', PRESET_REALTIME)
+                self._device.set_acquisition_value('preset_value', float(realtime))
+            self._preset = realtime
+
     def start(self):
-        self._device.start_run()
+        # free running acquisition, ended by stop()
+        self._set_preset(None)
+        self._requested = None
+        self._start_run()
         
+    def _start_run(self):
+        # the run start time is taken halfway the start call, so it can be matched with other time stamped data (e.g. I0)
+        t0 = time.time()
+        self._device.start_run()
+        self._starttime = 0.5*(t0+time.time())
+        self._active = True
+
     def stop(self):
         self._device.stop_run()
+        self._active = False
         
     def clear(self):
         self.data = {}
     
     def readout(self):
+        # the spectrum is read into a buffer that is reused by the next readout, use snapshot() to keep the data
+        nchan = self.nchan
+        if self._spectrum.shape[0] != nchan:
+            self._spectrum = np.zeros(nchan, dtype=np.uint32)
         temp = self._device.get_statistics()
-        self.data = {'spe_cts' : self._device.get_mca(self.nchan),
-                     'nchannels' : self.nchan,
-                     'gain_eV' : self.gain,
-                     'peakingtime_us' : self.peakingtime,
+        self._spectrum[:] = self._device.get_mca(nchan)
+        self.data = {'spe_cts' : self._spectrum,
+                     'nchannels' : nchan,
+                     'gain_eV' : self._settings['gain_eV'],
+                     'peakingtime_us' : self._settings['peakingtime_us'],
                      'realtime_s' : temp['runtime_s'],
                      'events_cts' : temp['events'],
                      'icr_cps' : temp['icr_cps'],
-                     'ocr_cps' : temp['ocr_cps']}
+                     'ocr_cps' : temp['ocr_cps'],
+                     'requested_realtime_s' : self._requested,
+                     'start_time' : self._starttime}
         del(temp) #shouldn't be needed in python, but maybe doesn't harm either
         
-    def acq(self, realtime:float):
+    def snapshot(self):
+        # copy of the last readout data that is not overwritten by the next readout
+        data = dict(self.data)
+        data['spe_cts'] = self.data['spe_cts'].copy()
+        return data
+        
+    def start_async(self, realtime:float):
+        # start a run of realtime seconds and return immediately, wait() ends it and reads out the data
         if realtime <= 0:
             raise ValueError(f"Argument realtime should be strictly positive: {realtime} s.")
-        else:
-            self.start()
-            time.sleep(realtime)
-            self.stop()
-            self.readout()
+        self._set_preset(realtime)
+        self._start_run()
+        self._tstart = time.monotonic()
+        self._requested = realtime
+
+    @property
+    def running(self):
+        if self._hwpreset is True:
+            return bool(self._device.get_run_data('run_active'))
+        if self._requested is None: # free running, see start()
+            return self._active
+        return self._active and time.monotonic()-self._tstart < self._requested
+
+    def wait(self):
+        if self._requested is None:
+            raise RuntimeError(f"{self._uname} runs free (start()) or was not started: end the run with stop() instead of wait().")
+        # nothing to poll for during most of the run
+        remaining = self._tstart+self._requested-time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        if self._hwpreset is True:
+            while self.running:
+                if time.monotonic()-self._tstart > self._requested+RUN_TIMEOUT:
+                    print(f"WARNING: preset run of {self._uname} did not end in time, stopping it.")
+                    break
+                time.sleep(RUN_POLL)
+        self.stop()
+        self.readout()
+
+    def acq(self, realtime:float):
+        self.start_async(realtime)
+        self.wait()
+
+
+class AcqWorker(threading.Thread):
+    """Persistent acquisition thread of a single detector, triggered through the barrier of an AcqGroup."""
+    def __init__(self, det, barrier:threading.Barrier):
+        threading.Thread.__init__(self, name="Acq"+det.uname, daemon=True)
+        self.det = det
+        self.realtime = None
+        self.error = None
+        self.done = threading.Event()
+        self._barrier = barrier
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                self._barrier.wait()
+            except threading.BrokenBarrierError:
+                break
+            if self.realtime is None: # stop request, see AcqGroup.close()
+                break
+            try:
+                self.det.acq(self.realtime)
+            except Exception as err:
+                self.error = err
+            self.done.set()
+
+
+class AcqGroup():
+    """Simultaneous acquisition on a list of detectors, each with a worker thread that is started once and reused.
+        All workers wait on a common barrier, so the detectors are started within the same instant."""
+    def __init__(self, dets):
+        self.dets = list(dets)
+        self._barrier = threading.Barrier(len(self.dets)+1)
+        self._workers = [AcqWorker(det, self._barrier) for det in self.dets]
+
+    def acq(self, realtime:float):
+        for worker in self._workers:
+            worker.realtime = realtime
+            worker.error = None
+            worker.done.clear()
+        self._barrier.wait() # releases all workers at once
+        for worker in self._workers:
+            worker.done.wait()
+        errors = [worker.det.uname+": "+str(worker.error) for worker in self._workers if worker.error is not None]
+        if len(errors) > 0:
+            raise RuntimeError("ERROR: acquisition failed for "+", ".join(errors))
+
+    def close(self):
+        for worker in self._workers:
+            worker.realtime = None
+        try:
+            self._barrier.wait(timeout=1.)
+        except threading.BrokenBarrierError:
+            pass
+        for worker in self._workers:
+            worker.join(timeout=1.)
         
 
 
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Handles the scan data files. A ScanWriter keeps a single HDF5 file open for the
+duration of a scan, with all datasets preallocated for the known number of scan points.
+"""
+
+import numpy as np
+import h5py
+import queue
+import threading
+
+FLUSH_INTERVAL = 10 # number of points after which the scan file is flushed to disk
+QUEUE_SIZE = 32 # number of scan points that can be waiting to be written before the scan has to wait
+# online correction models of the spectra in corrected/channelNN, see correction_factors()
+CORRECTIONS = {'deadtime': "spectra*ICR/OCR",
+               'deadtime_time': "spectra*ICR/OCR/realtime, counts/s",
+               'deadtime_I0': "spectra*ICR/OCR/I0_integral, counts/(mA*s)"}
+
+def correction_factors(model:str, icr, ocr, realtime, I0_integral):
+    # correction factor of each detector for one scan point; a detector without output counts is left uncorrected
+    #   NaN for the I0 model when the tube current was not recorded
+    icr, ocr, realtime = np.asarray(icr, dtype=float), np.asarray(ocr, dtype=float), np.asarray(realtime, dtype=float)
+    factor = np.divide(icr, ocr, out=np.ones_like(icr), where=ocr > 0)
+    if model == 'deadtime_time':
+        factor /= realtime
+    elif model == 'deadtime_I0':
+        factor /= I0_integral
+    elif model != 'deadtime':
+        raise ValueError(f"Unknown correction model {model}, choose from {list(CORRECTIONS)}")
+    return factor
+
+class ScanWriter():
+    """Scan file writer: create at scan start, store() each point, close() at scan end or abort."""
+    def __init__(self, filename, command, npoints, motX, motY, flush_interval=FLUSH_INTERVAL, columns=(), attrs=None, correction=None,
+                 rois=None):
+        # columns: names of additional per point values (e.g. energy, dwell time), supplied as data['columns'][name];
+        #   a (name, dtype) pair for values that are not stored as float, e.g. map indices
+        # attrs: scan description stored as file attributes (e.g. the mesh shape)
+        # correction: model (see CORRECTIONS) of the corrected spectra stored next to the raw ones, None for raw data only
+        # rois: {name: (start, end, unit)} of the ROIs supplied as data['roi'][name]; with a 'mesh_shape' in attrs these
+        #   are stored in map shape at data['columns']['index1'], ['index2'], otherwise per point
+        if correction is not None and correction not in CORRECTIONS:
+            raise ValueError(f"Unknown correction model {correction}, choose from {list(CORRECTIONS)}")
+        self.correction = correction
+        self.filename = filename
+        self.npoints = int(npoints)
+        self.flush_interval = int(flush_interval)
+        self.index = 0
+        self._channels = None
+        self._trace = False
+        self._dsets = {}
+        self._sumspec = []
+        self._maxspec = []
+        self._corrsumspec = []
+
+        self._h5 = h5py.File(filename, 'w')
+        self._h5.create_dataset('cmd', data=command)
+        self._h5.attrs['npoints'] = self.npoints
+        for key, value in (attrs or {}).items():
+            self._h5.attrs[key] = value
+        self._create('mot1', (self.npoints,)).attrs['Name'] = motX
+        self._create('mot2', (self.npoints,)).attrs['Name'] = motY
+        self._create('raw/I0', (self.npoints,))
+        self._create('raw/I0_integral', (self.npoints,))
+        self._create('raw/acquisition_time', (self.npoints,))
+        self._columns = []
+        for column in columns:
+            name, dtype = (column, 'f8') if isinstance(column, str) else column
+            self._create(name, (self.npoints,), dtype=dtype)
+            self._columns.append(name)
+        self._rois = dict(rois or {})
+        self._roimap = attrs is not None and 'mesh_shape' in attrs
+        self._roidsets = {}
+        for name, (start, end, unit) in self._rois.items():
+            if self._roimap:
+                # map points that were never measured (aborted scan) remain NaN
+                dset = self._h5.create_dataset(f'roi/{name}', shape=tuple(attrs['mesh_shape']), dtype='f8', fillvalue=np.nan)
+                self._roidsets[name] = dset
+            else:
+                dset = self._create(f'roi/{name}', (self.npoints,))
+            dset.attrs['start'] = start
+            dset.attrs['end'] = end
+            dset.attrs['unit'] = unit
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._h5 is None
+
+    def _create(self, name, shape, dtype='f8'):
+        # spectra are chunked per scan point, so a row write never has to decompress a neighbouring point
+        if len(shape) > 1:
+            chunks = (1,)+shape[1:]
+        else:
+            chunks = (min(shape[0], 1024),)
+        dset = self._h5.create_dataset(name, shape=shape, dtype=dtype, compression='gzip', compression_opts=4,
+                                       chunks=chunks, maxshape=(None,)+shape[1:])
+        self._dsets[name] = dset
+        return dset
+
+    def _create_trace(self):
+        # tube current trace during each point: sample times relative to the point start (s) and current (mA)
+        self._create('raw/I0_trace/time', (self.npoints,), dtype=h5py.vlen_dtype(np.float64))
+        self._create('raw/I0_trace/mA', (self.npoints,), dtype=h5py.vlen_dtype(np.float64))
+        self._trace = True
+
+    def _create_channels(self, data:dict):
+        self._channels = list(data['active_detectors'])
+        for index, det in enumerate(self._channels):
+            spe = np.asarray(data['spe'][index])
+            self._create(f'raw/channel{index:02d}/spectra', (self.npoints, spe.shape[0]), dtype=spe.dtype)
+            self._create(f'raw/channel{index:02d}/icr', (self.npoints,))
+            self._create(f'raw/channel{index:02d}/ocr', (self.npoints,))
+            self._create(f'raw/channel{index:02d}/realtime', (self.npoints,))
+            self._create(f'raw/channel{index:02d}/events', (self.npoints,))
+            # sum and max spectra are accumulated in memory and only written to file on flush
+            self._sumspec.append(np.zeros(spe.shape, dtype=np.result_type(spe.dtype, np.int64)))
+            self._maxspec.append(np.zeros(spe.shape, dtype=spe.dtype))
+            self._h5.create_dataset(f'raw/channel{index:02d}/sumspec', shape=spe.shape, dtype=self._sumspec[index].dtype, compression='gzip', compression_opts=4)
+            self._h5.create_dataset(f'raw/channel{index:02d}/maxspec', shape=spe.shape, dtype=spe.dtype, compression='gzip', compression_opts=4)
+            self._h5[f'raw/channel{index:02d}'].attrs['DetName'] = det
+            # detector settings do not change during a scan, so they are stored once
+            for key, value in data.get('settings', [{}]*len(self._channels))[index].items():
+                self._h5[f'raw/channel{index:02d}'].attrs[key] = value
+            if self.correction is not None:
+                self._create(f'corrected/channel{index:02d}/spectra', (self.npoints, spe.shape[0]))
+                self._corrsumspec.append(np.zeros(spe.shape))
+                self._h5.create_dataset(f'corrected/channel{index:02d}/sumspec', shape=spe.shape, dtype='f8', compression='gzip', compression_opts=4)
+        if self.correction is not None:
+            self._h5['corrected'].attrs['model'] = self.correction
+            self._h5['corrected'].attrs['description'] = CORRECTIONS[self.correction]
+
+    def store(self, data:dict):
+        if self.closed:
+            raise ValueError(f"Scan file {self.filename} is already closed.")
+        if self.index >= self.npoints:
+            raise IndexError(f"Scan file {self.filename} is full: {self.npoints} points stored.")
+        if self._channels is None:
+            self._create_channels(data)
+            if data.get('I0_trace') is not None:
+                self._create_trace()
+
+        i = self.index
+        self._dsets['mot1'][i] = data['motXpos']
+        self._dsets['mot2'][i] = data['motYpos']
+        self._dsets['raw/I0'][i] = data['I0']
+        self._dsets['raw/I0_integral'][i] = data.get('I0_integral', np.nan)
+        if self._trace is True and data.get('I0_trace') is not None:
+            self._dsets['raw/I0_trace/time'][i] = data['I0_trace'][0]
+            self._dsets['raw/I0_trace/mA'][i] = data['I0_trace'][1]
+        self._dsets['raw/acquisition_time'][i] = data['realtime_s']
+        for name in self._columns:
+            self._dsets[name][i] = data['columns'][name]
+        for name in self._rois:
+            if self._roimap:
+                self._roidsets[name][int(data['columns']['index1']), int(data['columns']['index2'])] = data['roi'][name]
+            else:
+                self._dsets[f'roi/{name}'][i] = data['roi'][name]
+        # per detector realtime and events are optional: the point realtime and NaN are used when they are not supplied
+        realtime = data.get('realtime', [data['realtime_s']]*len(self._channels))
+        events = data.get('events', [np.nan]*len(self._channels))
+        if self.correction is not None:
+            factors = correction_factors(self.correction, data['icr'], data['ocr'], realtime, data.get('I0_integral', np.nan))
+        for index in range(len(self._channels)):
+            spe = np.asarray(data['spe'][index])
+            self._dsets[f'raw/channel{index:02d}/spectra'][i,:] = spe
+            self._dsets[f'raw/channel{index:02d}/icr'][i] = data['icr'][index]
+            self._dsets[f'raw/channel{index:02d}/ocr'][i] = data['ocr'][index]
+            self._dsets[f'raw/channel{index:02d}/realtime'][i] = realtime[index]
+            self._dsets[f'raw/channel{index:02d}/events'][i] = events[index]
+            self._sumspec[index] += spe
+            np.maximum(self._maxspec[index], spe, out=self._maxspec[index])
+            if self.correction is not None:
+                corrected = spe*factors[index]
+                self._dsets[f'corrected/channel{index:02d}/spectra'][i,:] = corrected
+                self._corrsumspec[index] += corrected
+        self.index += 1
+
+        if self.index % self.flush_interval == 0:
+            self.flush()
+
+    def flush(self):
+        if not self.closed:
+            if self._channels is not None:
+                for index in range(len(self._channels)):
+                    self._h5[f'raw/channel{index:02d}/sumspec'][:] = self._sumspec[index]
+                    self._h5[f'raw/channel{index:02d}/maxspec'][:] = self._maxspec[index]
+                    if self.correction is not None:
+                        self._h5[f'corrected/channel{index:02d}/sumspec'][:] = self._corrsumspec[index]
+            self._h5.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        # an aborted scan leaves part of the preallocated points unused: trim them away
+        if self.index < self.npoints:
+            for dset in self._dsets.values():
+                dset.resize(self.index, axis=0)
+        self._h5.attrs['npoints_stored'] = self.index
+        self._h5.close()
+        self._h5 = None
+
+
+class AsyncScanWriter(threading.Thread):
+    """Stores the scan points of a ScanWriter on a dedicated thread, so the scan can move on while a point is written.
+        When the queue is full store() blocks until the writer has caught up.
+        An error on the writer thread is raised on the next store(), flush() or close() call."""
+    def __init__(self, writer:ScanWriter, maxsize=QUEUE_SIZE):
+        threading.Thread.__init__(self, name="ScanWriter", daemon=True)
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self.start()
+
+    @property
+    def closed(self):
+        return self.writer.closed
+
+    def run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    break
+                if self._error is None: # after an error the queue is still drained, so the scan is never left blocking
+                    self.writer.store(data)
+            except Exception as err:
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Storing data in {self.writer.filename} failed: {error}") from error
+
+    def store(self, data:dict):
+        self._check()
+        if not self.is_alive():
+            raise ValueError(f"Scan file {self.writer.filename} is already closed.")
+        self._queue.put(data)
+
+    def flush(self):
+        self._queue.join()
+        self._check()
+        self.writer.flush()
+
+    def close(self):
+        # drain all pending points before closing the file
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+        self.writer.close()
+        self._check()
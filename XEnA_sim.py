@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated hardware backends, so the XEnA control code can run without the instrument:
+    GCSDevice/GCSError    replace pipython (PI stage controllers)
+    XiaMicroDXP and the module level init/deinit functions replace xia_microdxp_api_v2_2023 (PNDetector DPP),
+                          i.e. this module can be used as dpp_api
+    nidaqmx               replaces the nidaqmx package (tube control I/O)
+Simulation is switched on by setting the environment variable XENA_SIMULATE=1, or by "enabled": true in lib/sim.json.
+The simulation parameters (see CONFIG) can be changed in lib/sim.json, or in another file set by XENA_SIM_CONFIG.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+CONFIG = {'enabled' : False,
+          'latency' : 0.002,      # s, duration of each simulated controller/DPP call (USB round trip)
+          'velocity' : 10.,       # mm/s or deg/s, stage velocity until VEL is called
+          'home_distance' : 50.,  # mm, distance travelled by a reference move
+          'travel' : (-1000., 1000.), # mm or deg, travel range reported by the simulated controllers
+          'icr' : 2.e4,           # cps, input count rate of the simulated detector
+          'deadtime' : 2.e-6,     # s, paralyzable dead time per event at a peaking time of 1 us
+          'nchannels' : 4096,
+          'gain' : 5.,            # eV/channel
+          'daq_noise' : 0.005,    # V, noise on the simulated analog inputs
+          'daq_loopback' : {'Dev1/ai0': 'Dev1/ao0', 'Dev1/ai4': 'Dev1/ao1'}, # analog inputs that monitor an analog output
+          'interlock_open' : False, # state of the simulated door interlock
+          'tube_gui' : False,     # start the tube control window when simulating (requires PyQt5)
+          'basedir' : os.path.join(tempfile.gettempdir(), 'XEnA').replace('\\', '/')+'/' # data directory when simulating
+          }
+
+_configfile = os.environ.get('XENA_SIM_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib', 'sim.json'))
+if os.path.isfile(_configfile):
+    with open(_configfile, encoding='utf-8') as _file:
+        CONFIG.update(json.load(_file))
+SIMULATE = os.environ.get('XENA_SIMULATE', '1' if CONFIG['enabled'] else '0') not in ('', '0')
+
+_rng = np.random.default_rng()
+_lock = threading.Lock()
+
+def _latency():
+    if CONFIG['latency'] > 0:
+        time.sleep(CONFIG['latency'])
+
+def _value(values):
+    # GCS commands accept a single value or a list of values (one per axis); there is a single axis here
+    if isinstance(values, (list, tuple)):
+        return values[0]
+    if isinstance(values, dict):
+        return list(values.values())[0]
+    return values
+
+
+#### PI stages (pipython) ####
+
+class GCSError(Exception):
+    pass
+
+_axes = {} # usb serial: axis state, so a reconnected stage keeps its position
+
+class _Axis():
+    """Single axis moving at constant velocity from pos0 (at t0) to target."""
+    def __init__(self):
+        self.pos0 = CONFIG['home_distance']
+        self.target = self.pos0
+        self.t0 = time.monotonic()
+        self.velocity = CONFIG['velocity']
+        self.referenced = False
+
+    def position(self):
+        distance = self.target-self.pos0
+        travelled = self.velocity*(time.monotonic()-self.t0)
+        if travelled >= abs(distance):
+            return self.target
+        return self.pos0 + np.sign(distance)*travelled
+
+    def moving(self):
+        return self.position() != self.target
+
+    def move(self, target):
+        with _lock:
+            self.pos0 = self.position()
+            self.t0 = time.monotonic()
+            self.target = float(target)
+
+class GCSDevice():
+    """Simulated PI GCS controller with a single axis '1'."""
+    def __init__(self, devname=''):
+        self.devname = devname
+        self.axes = ['1']
+        self._axis = None
+
+    def ConnectUSB(self, serialnum):
+        _latency()
+        self._axis = _axes.setdefault(serialnum, _Axis())
+        self._serial = serialnum
+
+    def CloseConnection(self):
+        self._axis = None
+
+    def qIDN(self):
+        _latency()
+        return f"(c)2026 Simulated GCS controller {self.devname}, {self._serial}\n"
+
+    def SVO(self, axes, values=None):
+        _latency()
+
+    def RON(self, axes, values=None):
+        _latency()
+
+    def qRON(self, axes=None):
+        _latency()
+        return {'1': True}
+
+    def VEL(self, axes, values=None):
+        _latency()
+        # a velocity change during a move applies to the remainder of the move
+        self._axis.move(self._axis.target)
+        self._axis.velocity = float(_value(values))
+
+    def HasFRF(self):
+        return True
+
+    def FRF(self, axes=None):
+        _latency()
+        self._axis.move(0.)
+        self._axis.referenced = True
+
+    def FPL(self, axes=None):
+        self.FRF(axes)
+
+    def IsControllerReady(self):
+        _latency()
+        return not self._axis.moving()
+
+    def MOV(self, axes, values=None):
+        _latency()
+        self._axis.move(_value(values))
+
+    def MVR(self, axes, values=None):
+        _latency()
+        self._axis.move(self._axis.target+_value(values))
+
+    def HLT(self, axes=None):
+        _latency()
+        self._axis.move(self._axis.position())
+
+    def qTMN(self, axes=None):
+        _latency()
+        return {'1': float(CONFIG['travel'][0])}
+
+    def qTMX(self, axes=None):
+        _latency()
+        return {'1': float(CONFIG['travel'][1])}
+
+    def qPOS(self, axes=None):
+        _latency()
+        return {'1': self._axis.position()}
+
+    def qONT(self, axes=None):
+        _latency()
+        return {'1': not self._axis.moving()}
+
+    def IsMoving(self, axes=None):
+        _latency()
+        return {'1': self._axis.moving()}
+
+
+#### PNDetector DPP (xia_microdxp_api_v2_2023) ####
+
+def init_xia_systems():
+    _latency()
+
+def deinit_xia_systems():
+    _latency()
+
+def number_of_detectors():
+    return 1
+
+def xia_get_version_info():
+    return "simulated"
+
+class XiaMicroDXP():
+    """Simulated microDXP: Poisson spectra of a few fluorescence lines on a background at CONFIG['icr']."""
+    LINES = ((6.404, 1.), (7.058, 0.15), (8.048, 0.6), (8.905, 0.1)) # keV, relative intensity (Fe and Cu K lines)
+
+    def __init__(self, channel=0):
+        self._channel = channel
+        self._nchan = int(CONFIG['nchannels'])
+        self._peakingtime = 1.
+        self._preset_type = 0.
+        self._preset_value = 0.
+        self._tstart = None
+        self._runtime = 0.
+        self._events = 0
+        self._icr = 0.
+        self._ocr = 0.
+        self._spectrum = np.zeros(self._nchan, dtype=np.uint32)
+
+    def simple_get_serial_number(self):
+        return f"SIM{self._channel:05d}"
+
+    def get_mca_length(self):
+        _latency()
+        return self._nchan
+
+    def set_number_mca_channels(self, value):
+        _latency()
+        self._nchan = int(value)
+
+    def get_gain(self):
+        _latency()
+        return CONFIG['gain']*CONFIG['nchannels']/self._nchan
+
+    def simple_get_all_setting(self):
+        _latency()
+        return {'selected_peaking_time': self._peakingtime, 'number_mca_channels': self._nchan}
+
+    def simple_set_peaking_time(self, value):
+        _latency()
+        self._peakingtime = float(value)
+
+    def set_acquisition_value(self, name, value):
+        _latency()
+        setattr(self, '_'+name, float(value))
+
+    def _elapsed(self):
+        if self._tstart is None:
+            return self._runtime
+        elapsed = time.monotonic()-self._tstart
+        if self._preset_type == 1.:
+            elapsed = min(elapsed, self._preset_value)
+        return elapsed
+
+    def get_run_data(self, name):
+        _latency()
+        if name == 'run_active':
+            return self._tstart is not None and not (self._preset_type == 1. and time.monotonic()-self._tstart >= self._preset_value)
+        raise KeyError(name)
+
+    def start_run(self):
+        _latency()
+        self._tstart = time.monotonic()
+
+    def stop_run(self):
+        _latency()
+        if self._tstart is not None:
+            self._runtime = self._elapsed()
+            self._tstart = None
+            self._acquire(self._runtime)
+
+    def _acquire(self, runtime):
+        energies = (np.arange(self._nchan)+0.5)*self.get_gain()/1000.
+        shape = 0.2*np.exp(-energies/4.) # background
+        for energy, intensity in self.LINES:
+            shape += intensity*np.exp(-0.5*((energies-energy)/0.065)**2)
+        shape /= shape.sum()
+        tau = CONFIG['deadtime']*self._peakingtime
+        self._icr = CONFIG['icr']
+        self._ocr = self._icr*np.exp(-self._icr*tau)
+        self._events = _rng.poisson(self._ocr*runtime)
+        self._spectrum = _rng.poisson(shape*self._events).astype(np.uint32)
+
+    def get_statistics(self):
+        _latency()
+        return {'runtime_s': self._runtime,
+                'events': self._events,
+                'icr_cps': self._icr,
+                'ocr_cps': self._ocr}
+
+    def get_mca(self, nchan):
+        _latency()
+        return self._spectrum[:nchan].tolist()
+
+
+#### NI-DAQmx (nidaqmx) ####
+
+_daq = {} # physical channel: last written value (outputs)
+
+class _Channels():
+    def __init__(self, task, kind):
+        self._task = task
+        self._kind = kind
+
+    def _add(self, physical_channel, **kwargs):
+        for channel in physical_channel.split(','):
+            self._task._channels.append((self._kind, channel.strip()))
+
+    add_ai_voltage_chan = _add
+    add_ao_voltage_chan = _add
+    add_di_chan = _add
+    add_do_chan = _add
+
+class _Timing():
+    """Sample clock of a simulated task; change detection is not simulated, as on devices that lack it."""
+    def __init__(self, task):
+        self._task = task
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None, sample_mode=None, samps_per_chan=1000):
+        self._task._rate = float(rate)
+
+class Task():
+    """Simulated nidaqmx.Task: outputs are remembered, analog inputs read back the output they monitor (CONFIG['daq_loopback']).
+        With a sample clock (timing.cfg_samp_clk_timing) the samples become available at the clock rate after start()."""
+    def __init__(self, new_task_name=''):
+        self._channels = []
+        self.ai_channels = _Channels(self, 'ai')
+        self.ao_channels = _Channels(self, 'ao')
+        self.di_channels = _Channels(self, 'di')
+        self.do_channels = _Channels(self, 'do')
+        self.timing = _Timing(self)
+        self.in_stream = self
+        self._rate = None
+        self._t0 = None
+        self._nread = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._t0 = None
+
+    def start(self):
+        self._t0 = time.monotonic()
+        self._nread = 0
+
+    def stop(self):
+        self._t0 = None
+
+    def wait_until_done(self, timeout=10.):
+        pass
+
+    def _read_channel(self, kind, channel, size=None):
+        if kind == 'ai':
+            source = CONFIG['daq_loopback'].get(channel)
+            value = _daq.get(source, 0.) if _daq.get('interlock', False) else 0.
+            return value + _rng.normal(0., CONFIG['daq_noise'], size)
+        if kind == 'di':
+            return bool(CONFIG['interlock_open'])
+        return _daq.get(channel, False)
+
+    def _read_many(self, data, nsamples, timeout):
+        # hardware timed read: blocks until the sample clock has produced nsamples more samples per channel
+        if self._rate is None:
+            raise RuntimeError("Simulated DAQ task has no sample clock.")
+        if self._t0 is None:
+            self.start()
+        wait = self._t0+(self._nread+nsamples)/self._rate-time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("Simulated DAQ read timed out.")
+        if wait > 0:
+            time.sleep(wait)
+        self._nread += nsamples
+        for row, (kind, channel) in enumerate(self._channels):
+            data[row, :nsamples] = self._read_channel(kind, channel, nsamples)
+        return nsamples
+
+    def read(self, number_of_samples_per_channel=None, timeout=10.):
+        _latency()
+        if number_of_samples_per_channel is None:
+            values = [self._read_channel(kind, channel) for kind, channel in self._channels]
+        else:
+            values = [[self._read_channel(kind, channel) for i in range(number_of_samples_per_channel)] for kind, channel in self._channels]
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    def write(self, data, auto_start=False, timeout=10.):
+        _latency()
+        if len(self._channels) == 1:
+            data = [data]
+        for (kind, channel), value in zip(self._channels, data):
+            _daq[channel] = value
+            if kind == 'do':
+                _daq['interlock'] = bool(value) # the simulated tube only produces X-rays with the interlock switched on
+        return 1
+
+class AnalogMultiChannelReader():
+    """Simulated nidaqmx.stream_readers.AnalogMultiChannelReader."""
+    def __init__(self, task_in_stream):
+        self._task = task_in_stream
+
+    def read_many_sample(self, data, number_of_samples_per_channel=1, timeout=10.):
+        return self._task._read_many(data, number_of_samples_per_channel, timeout)
+
+nidaqmx = SimpleNamespace(Task=Task,
+                          stream_readers=SimpleNamespace(AnalogMultiChannelReader=AnalogMultiChannelReader),
+                          constants=SimpleNamespace(TerminalConfiguration=SimpleNamespace(RSE=10083, NRSE=10078, DIFF=10106, DEFAULT=-1),
+                                                    AcquisitionType=SimpleNamespace(FINITE=10178, CONTINUOUS=10123, HW_TIMED_SINGLE_POINT=12522),
+                                                    Signal=SimpleNamespace(CHANGE_DETECTION_EVENT=12511)))
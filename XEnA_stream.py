@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Live stream of the scan data: XEnA_control publishes the start, every point and the end of a scan on a local socket
+(ADDRESS), so plots and monitors can follow a scan at the acquisition rate without reading the scan file.
+Each message is a 4 byte (big-endian) header length, a JSON header and the raw bytes of the buffers listed in
+header['buffers'] (name, dtype, shape, nbytes), e.g. the spectrum of each detector for subscribers that asked for them.
+Every subscriber has a bounded queue: when a subscriber does not keep up, messages are dropped for that subscriber
+(counted in header['dropped']) and the scan never waits.
+    Subscribe:  for header, buffers in StreamClient(spectra=True): ...
+"""
+
+import json
+import queue
+import socket
+import struct
+import threading
+import numpy as np
+
+ADDRESS = ('localhost', 6341) # local socket of the stream
+QUEUE_SIZE = 256 # number of messages kept per subscriber before messages are dropped
+ACCEPT_POLL = 0.5 # s, interval at which the server checks whether it is closed
+SUBSCRIBE_TIMEOUT = 1. # s, time a new subscriber has to send its subscription
+_LENGTH = struct.Struct('>I')
+
+
+def _send(sock, header:dict, buffers=()):
+    header = json.dumps(header).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(header))+header)
+    for buffer in buffers:
+        sock.sendall(memoryview(buffer).cast('B'))
+
+def _recv_exact(sock, nbytes:int):
+    data = bytearray(nbytes)
+    view = memoryview(data)
+    while nbytes > 0:
+        n = sock.recv_into(view[-nbytes:], nbytes)
+        if n == 0:
+            raise EOFError("Stream closed.")
+        nbytes -= n
+    return data
+
+def _recv(sock):
+    # (header, {name: array}) of the next message
+    length, = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    header = json.loads(_recv_exact(sock, length).decode('utf-8'))
+    buffers = {}
+    for buffer in header.get('buffers', []):
+        data = _recv_exact(sock, buffer['nbytes'])
+        buffers[buffer['name']] = np.frombuffer(data, dtype=buffer['dtype']).reshape(buffer['shape'])
+    return header, buffers
+
+def _jsonable(value):
+    # numpy scalars and arrays (positions, rates, ROI values) as plain JSON values, NaN as null
+    if isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+class _Subscriber(threading.Thread):
+    """Sends the queued messages to one subscriber, on its own thread."""
+    def __init__(self, sock, spectra:bool):
+        threading.Thread.__init__(self, name="StreamSubscriber", daemon=True)
+        self.sock = sock
+        self.spectra = spectra
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.start()
+
+    def put(self, header:dict, buffers):
+        try:
+            self._queue.put_nowait((header, buffers if self.spectra else ()))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        try:
+            while True:
+                message = self._queue.get()
+                if message is None:
+                    break
+                header, buffers = message
+                header = dict(header, dropped=self.dropped)
+                if not self.spectra:
+                    header['buffers'] = []
+                _send(self.sock, header, buffers)
+        except OSError: # subscriber went away
+            pass
+        finally:
+            self.sock.close()
+
+    def close(self):
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full: # the subscriber is not reading, so its socket is closed directly
+            self.sock.close()
+
+
+class StreamServer():
+    """Publisher of the scan stream: publish() hands a message to all subscribers and returns immediately."""
+    def __init__(self, address=ADDRESS):
+        self.address = address
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._point = 0
+        self._sock = socket.create_server(address)
+        self._sock.settimeout(ACCEPT_POLL)
+        threading.Thread(target=self._accept, name="StreamServer", daemon=True).start()
+
+    @property
+    def nsubscribers(self):
+        with self._lock:
+            self._subscribers = [sub for sub in self._subscribers if sub.is_alive()]
+            return len(self._subscribers)
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError: # server closed
+                break
+            # the subscription, e.g. {'spectra': true}, is the first message of the subscriber
+            sock.settimeout(SUBSCRIBE_TIMEOUT)
+            try:
+                request, _ = _recv(sock)
+            except (OSError, EOFError, ValueError):
+                sock.close()
+                continue
+            sock.settimeout(None)
+            with self._lock:
+                self._subscribers.append(_Subscriber(sock, bool(request.get('spectra', False))))
+
+    def publish(self, kind:str, info:dict, spectra=()):
+        # kind: 'start', 'point' or 'end' of a scan; spectra (one array per detector) are only sent to subscribers that asked for them
+        if kind == 'start':
+            self._point = 0
+        point = self._point
+        if kind == 'point':
+            self._point += 1
+        if self.nsubscribers == 0:
+            return
+        header = {'type': kind, **_jsonable(info)}
+        buffers = []
+        if kind == 'point':
+            header['point'] = point
+            buffers = [np.ascontiguousarray(spe) for spe in spectra]
+            header['buffers'] = [{'name': f'spe{index:02d}', 'dtype': spe.dtype.str, 'shape': list(spe.shape), 'nbytes': spe.nbytes}
+                                 for index, spe in enumerate(buffers)]
+        with self._lock:
+            for sub in self._subscribers:
+                sub.put(header, buffers)
+
+    def close(self):
+        self._closed.set()
+        self._sock.close()
+        with self._lock:
+            for sub in self._subscribers:
+                sub.close()
+            self._subscribers = []
+
+
+class StreamClient():
+    """Subscriber of the scan stream. recv() returns (header, {name: array}) of the next message; iterating over the
+        client yields messages until the stream is closed. With spectra the spectrum of each detector is included."""
+    def __init__(self, address=ADDRESS, spectra:bool=False):
+        self._sock = socket.create_connection(address)
+        _send(self._sock, {'spectra': bool(spectra)})
+
+    def recv(self):
+        return _recv(self._sock)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.recv()
+            except (EOFError, OSError):
+                return
+
+    def close(self):
+        self._sock.close()
+
+
+if __name__ == "__main__":
+    # follow the running scans in a console
+    for header, buffers in StreamClient():
+        if header['type'] == 'point':
+            print(header['point'], header['motXpos'], header['motYpos'], header['I0'], header['roi'], header['dropped'])
+        else:
+            print(header)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Client side of the tube control service (XEnA_tube_service): the request protocol, TubeClient and starting the service
+or control window. Imports neither the DAQ nor the Qt packages, so scans only need this module to read I0.
+Requests and replies are JSON messages preceded by their 4 byte (big-endian) length. Each request carries the token
+that the service writes to TOKEN_FILE when it starts, a file only the user running the service can read, so other
+users on the control PC cannot operate the tube.
+"""
+
+import json
+import os
+import secrets
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from functools import partial
+import numpy as np
+
+ADDRESS = ('localhost', 6340) # local socket of the service
+CONNECT_TIMEOUT = 20. # s, time allowed for a started service to accept connections
+TOKEN_FILE = os.path.join(os.path.expanduser('~'), '.xena_tube_token') # access token of the running service
+# TubeController methods that clients can request
+API = ('status', 'messages', 'set_interlock', 'set_voltage', 'set_current', 'set_max', 'set_min', 'cancel',
+       'wait_ramp', 'interval', 'window', 'shutdown')
+
+_LENGTH = struct.Struct('>I')
+
+def _default(value):
+    # numpy values in the replies (e.g. the monitor samples of window()) as plain JSON values
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} cannot be sent to a tube control client")
+
+def _new_token(path=TOKEN_FILE):
+    # random token of a service start, in a file that is only accessible to the current user
+    token = secrets.token_hex(32)
+    if os.path.exists(path):
+        os.remove(path) # os.open only applies the mode to a new file
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as file:
+        file.write(token)
+    return token
+
+def _read_token(path=TOKEN_FILE):
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except OSError as ex:
+        raise PermissionError(f"Cannot read the tube control service token {path}: {ex}") from ex
+
+def _send(sock, message):
+    message = json.dumps(message, default=_default).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(message))+message)
+
+def _recv_exact(sock, nbytes:int):
+    data = bytearray()
+    while len(data) < nbytes:
+        chunk = sock.recv(nbytes-len(data))
+        if chunk == b'':
+            raise EOFError("Tube control connection closed.")
+        data += chunk
+    return bytes(data)
+
+def _recv(sock):
+    length, = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return json.loads(_recv_exact(sock, length).decode('utf-8'))
+
+
+class TubeClient():
+    """Connection to the tube control service. Each API method can be called on the client, e.g.
+        TubeClient().status(); a call blocks until the reply is received. Calls are serialised, so a client can be
+        shared by threads; a long wait_ramp() blocks the other calls on the same client."""
+    def __init__(self, address=ADDRESS, token_file=TOKEN_FILE):
+        self._sock = socket.create_connection(address)
+        try:
+            self._token = _read_token(token_file)
+        except PermissionError:
+            self._sock.close()
+            raise
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            _send(self._sock, {'token': self._token, 'method': method, 'args': list(args), 'kwargs': kwargs})
+            reply = _recv(self._sock)
+        if reply['status'] == 'error':
+            raise RuntimeError(reply['message'])
+        return reply['result']
+
+    def __getattr__(self, name):
+        if name in API:
+            return partial(self._call, name)
+        raise AttributeError(name)
+
+    def close(self):
+        self._sock.close()
+
+
+def _spawn(script):
+    # separate process that does not receive the ctrl+c (motor abort) of the console that started it
+    kwargs = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP} if sys.platform == 'win32' else {'start_new_session': True}
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, os.path.join(here, script)], cwd=here, **kwargs)
+
+def connect(start=True, address=ADDRESS, timeout=CONNECT_TIMEOUT):
+    # TubeClient of the running service; with start the service is started when it is not running yet
+    try:
+        return TubeClient(address)
+    except ConnectionRefusedError:
+        if start is False:
+            raise
+    print("Starting tube control service...")
+    process = _spawn('XEnA_tube_service.py')
+    t0 = time.monotonic()
+    while True:
+        time.sleep(0.2)
+        try:
+            return TubeClient(address)
+        except (ConnectionRefusedError, PermissionError): # not listening or token not written yet
+            if process.poll() is not None or time.monotonic()-t0 > timeout:
+                raise ConnectionRefusedError("Tube control service did not start.")
+
+def start_gui():
+    # the tube control window, as a separate process (client of the service)
+    return _spawn('XEnA_tube_control.pyw')
@@ -5,39 +5,45 @@ Created on Mon May 31 08:49:47 2021
 @author: prrta
 """
 
-# Connection layout:
-#  DAQ          tube
-# AO GND ---- DB9 pin 9
-# AO 0 ------ DB9 pin 3   # kV adj  0-10V  = 0-50kV
-# AO 1 ------ DB9 pin 6   # mA adj  0-10V  = 0-2mA
-
-# AI GND ---- J4 pin 1
-# AI 0 ------ J4 pin 2    # kV mon
-# AI 1 ------ J4 pin 3    # mA mon
-
-# DO PF2.0 (Active Drive) ------ connector J4 pin 4 # Interlock  5V
-#       nidaqmx.constants.DigitalDriveType.ACTIVE_DRIVE (= 12573)
+# Connection layout and DAQ channels: see XEnA_tube_daq
+# The tube itself is controlled by the tube control service (XEnA_tube_service), which is started when it is not
+#   running yet. This window is a client of that service: closing it leaves the tube monitored and I0 available.
 
 import sys
-from PyQt5.QtCore import Qt, QSize, QCoreApplication
+from collections import deque
+from PyQt5.QtCore import Qt, QSize, QObject, QTimer
 from PyQt5.QtGui import QDoubleValidator, QIcon, QPixmap
 from PyQt5.QtWidgets import QApplication, QWidget, QHBoxLayout, QVBoxLayout,\
     QLabel, QLineEdit, QScrollArea, QPushButton, QRadioButton, QMessageBox
 
 
-import time
-import nidaqmx  # pip install nidaqmx, https://itom.bitbucket.io/plugindoc/plugins/ad-converters/niDAQmx.html
-from nidaqmx.constants import TerminalConfiguration
-import threading
-import numpy as np
-import threading
+import XEnA_tube_client as Xtc
+
+MESSAGE_LINES = 2000 # number of messages kept in the message window
+MESSAGE_RATE = 10. # Hz, maximal update rate of the message window
+POLL_RATE = 5. # Hz, rate at which the tube status and messages are requested from the service
+
+
+class MessageLog(QObject):
+    """Contents of the message window: the last MESSAGE_LINES messages, shown at most MESSAGE_RATE times per second.
+        add() is called on the GUI thread. Messages are logged to file by the tube control service."""
+    def __init__(self, label:QLabel, parent=None):
+        super(MessageLog, self).__init__(parent)
+        self.label = label
+        self.lines = deque(maxlen=MESSAGE_LINES)
+        self._changed = False
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self._show)
+        self.timer.start(int(1000/MESSAGE_RATE))
 
-kVmon_ID = "Dev1/ai0"
-mAmon_ID = "Dev1/ai4"
-kVset_ID = "Dev1/ao0"
-mAset_ID = "Dev1/ao1"
-interlock_ID = "Dev1/port2/line0"
-ILmon_ID = "Dev1/port1/line3"
+    def add(self, text:str):
+        self.lines.append(text)
+        self._changed = True
+
+    def _show(self):
+        if self._changed is True:
+            self.label.setText('\n'.join(self.lines))
+            self._changed = False
 
 
 class XEnA_tube_gui(QWidget):
@@ -58,22 +64,9 @@ class XEnA_tube_gui(QWidget):
         self.label_main = QLabel("XEnA Source Control")
         layout_main.addWidget(self.label_main)
         
-        with nidaqmx.Task() as task:
-            task.do_channels.add_do_chan(interlock_ID)
-            self.interlock_state = task.read()
-            task.wait_until_done()
+        self.interlock_state = False
         self.switch_interlock = QPushButton()
-        # check if interlocks are interrupted
-        with nidaqmx.Task() as task:
-            task.di_channels.add_di_chan(ILmon_ID)
-            value = task.read()
-            task.wait_until_done()
-        if value is True:
-            self.interlock_state = False
-        if self.interlock_state is False:
-            self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_off.gif")))
-        else:
-            self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_on.gif")))
+        self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_off.gif")))
         self.switch_interlock.setIconSize(QSize(300, 150))
         layout_interlock.addWidget(self.switch_interlock)
         layout_main.addLayout(layout_interlock)
@@ -117,7 +110,7 @@ class XEnA_tube_gui(QWidget):
         layout_current.addStretch()
         layout_main.addLayout(layout_current)
         
-        self.message_win = QLabel('Connecting... Wait 10s for initialisation...')
+        self.message_win = QLabel()
         font2 = self.font()
         font2.setPointSize(10)
         self.message_win.setFont(font2)
@@ -132,6 +125,7 @@ class XEnA_tube_gui(QWidget):
         layout_messages.addWidget(self.scroll_win)
         layout_main.addLayout(layout_messages)
         self.scroll_win.verticalScrollBar().rangeChanged.connect(lambda: self.scroll_win.verticalScrollBar().setValue(self.scroll_win.verticalScrollBar().maximum())) # Set scrollbar to max value when range changed
+        self.log = MessageLog(self.message_win, parent=self)
 
         rampbar = QHBoxLayout()
         self.ramp_fast = QRadioButton("Fast Ramp")
@@ -139,6 +133,9 @@ class XEnA_tube_gui(QWidget):
         self.ramp_slow = QRadioButton("Slow Ramp")
         rampbar.addWidget(self.ramp_slow)
         self.ramp_slow.setChecked(True)
+        self.ramp_stop = QPushButton("STOP")
+        self.ramp_stop.setMinimumWidth(50)
+        rampbar.addWidget(self.ramp_stop)
         rampbar.addStretch()
         layout_main.addLayout(rampbar)
         
@@ -153,348 +150,122 @@ class XEnA_tube_gui(QWidget):
         self.field_mAset.returnPressed.connect(self.set_current)
         self.maxvolt.clicked.connect(self.set_max_voltage)
         self.minvolt.clicked.connect(self.set_min_voltage)
-        # start additional thread for tube monitoring
-        self.monitor = True
-        self.thread = threading.Thread(target=self.tube_monitor)
-        self.thread.start()
-
-    def tube_monitor(self):
-        self.stop = threading.Event()
-        
-        voltage = np.zeros(10)
-        current = np.zeros(10)
-        time.sleep(7) #have to sleep a while here to give rest of GUI time to spawn
+        self.ramp_stop.clicked.connect(self.cancel_ramp)
+        self.client = None
+        self.nmessages = 0 # index of the next message of the service
         try:
-            with nidaqmx.Task() as task:
-                task.ai_channels.add_ai_voltage_chan(kVmon_ID, terminal_config = TerminalConfiguration.RSE) #kV monitor
-                task.read()
-                task.wait_until_done()
-            with nidaqmx.Task() as task:
-                task.ai_channels.add_ai_voltage_chan(mAmon_ID, terminal_config = TerminalConfiguration.RSE) #mA monitor
-                task.read()
-                task.wait_until_done()
-            with nidaqmx.Task() as task:
-                task.di_channels.add_di_chan(ILmon_ID) #interlock monitor: High->interlock broken
-                task.read()
-                task.wait_until_done()
+            self.client = Xtc.connect(start=True)
         except Exception as ex:
             self.add_message("----------------")
             self.add_message(str(ex))
             self.add_message("========")
-            self.add_message("**ERROR: Could not connect to NI-DAQmx monitor input channels.")
+            self.add_message("**ERROR: Could not connect to the tube control service.")
             return
+        # the service is polled on the GUI thread, so the window is only ever updated from here
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(int(1000/POLL_RATE))
+        self.poll()
+
+    def call(self, method, *args, **kwargs):
+        # request to the tube control service; returns None when it fails
+        if self.client is None:
+            self.add_message("**ERROR: not connected to the tube control service.")
+            return None
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except (EOFError, OSError) as ex:
+            self.add_message(str(ex))
+            self.add_message("**ERROR: lost connection to the tube control service.")
+            self.timer.stop()
+            self.client = None
+        except Exception as ex:
+            self.add_message(str(ex))
+        return None
 
-        output = self.message_win.text()
-        output += ' Connected.\n'
-        self.message_win.setText(output)
-
-        while (not self.stop.wait(1)):
-            if self.monitor == True:
-                try:
-                    for i in range(10): #display an averaged value of 10 measurements within approx 1s.
-                        with nidaqmx.Task() as task:
-                            task.ai_channels.add_ai_voltage_chan(kVmon_ID, terminal_config = TerminalConfiguration.RSE) #kV monitor
-                            value = task.read()
-                            task.wait_until_done()
-                        voltage[i] = value/10.*50.
-                        with nidaqmx.Task() as task:
-                            task.ai_channels.add_ai_voltage_chan(mAmon_ID, terminal_config = TerminalConfiguration.RSE) #mA monitor
-                            value = task.read()
-                            task.wait_until_done()
-                        current[i] = value/10.*2.
-                        time.sleep(0.1)
-                    self.field_mAmon.setText("{:.3f}".format(np.average(current)))
-                    self.field_kVmon.setText("{:.3f}".format(np.average(voltage)))
-                except Exception:
-                    pass
-                try:
-                    with nidaqmx.Task() as task:
-                        task.di_channels.add_di_chan(ILmon_ID) #interlock monitor: High->interlock broken
-                        value = task.read()
-                        task.wait_until_done()
-                    if value is True and self.interlock_state is True:
-                        self.interlock_state = False
-                        self.add_message("========")
-                        self.add_message("**ERROR: Interlock is interrupted. Are any doors open or is power cut?")
-                        with nidaqmx.Task() as task:
-                            task.do_channels.add_do_chan(interlock_ID)
-                            task.write(self.interlock_state, auto_start=True)
-                            task.wait_until_done()
-                        self.field_kVset.setText("{:.3f}".format(0.))
-                        self.field_mAset.setText("{:.3f}".format(0.))
-                        with nidaqmx.Task() as task:
-                            task.ao_channels.add_ao_voltage_chan(mAset_ID)
-                            task.write(0., auto_start=True)
-                            task.wait_until_done()
-                        with nidaqmx.Task() as task:
-                            task.ao_channels.add_ao_voltage_chan(kVset_ID)
-                            task.write(0., auto_start=True)
-                            task.wait_until_done()
-                        self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_off.gif")))
-                except:
-                    pass
+    def poll(self):
+        status = self.call('status')
+        if status is None:
+            return
+        self.nmessages, messages = self.call('messages', self.nmessages) or (self.nmessages, [])
+        for text in messages:
+            self.add_message(text)
+        if status['progress'] is not None:
+            self.show_progress(status['progress'])
+        else:
+            self.show_monitor(status['kV'], status['mA'])
+        if status['interlock_on'] != self.interlock_state:
+            self.interlock_changed(status['interlock_on'])
+
+    def show_monitor(self, kV, mA):
+        self.field_mAmon.setText("{:.3f}".format(mA))
+        self.field_kVmon.setText("{:.3f}".format(kV))
+
+    def interlock_changed(self, on):
+        # the service reports why the interlock went off (switched off or interrupted)
+        self.interlock_state = on
+        if on is True:
+            self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_on.gif")))
+        else:
+            self.field_kVset.setText("{:.3f}".format(0.))
+            self.field_mAset.setText("{:.3f}".format(0.))
+            self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_off.gif")))
 
     def toggle_interlock(self):
         if self.interlock_state is False: # if interlock off, set voltage to 0. If on set voltage to 5
             # warning for water cooling
-            if QMessageBox.question(self,'', "Confirm if detector water cooling is on:", QMessageBox.Yes | QMessageBox.No) == QMessageBox.Yes:
-                self.interlock_state = True
-                self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_on.gif")))
+            if QMessageBox.question(self,'', "Confirm if detector water cooling is on:", QMessageBox.Yes | QMessageBox.No) != QMessageBox.Yes:
+                return
+            state = self.call('set_interlock', True)
         else:
-            self.interlock_state = False
-            self.field_kVset.setText("{:.3f}".format(0.))
-            self.field_mAset.setText("{:.3f}".format(0.))
-            self.ramp_voltage(0., kVset_ID)
-            self.ramp_voltage(0., mAset_ID)
-            self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_off.gif")))
+            # the service ramps the tube down before switching the interlock off
+            state = self.call('set_interlock', False)
+        if state is not None:
+            self.interlock_changed(state)
 
-        try:            
-            with nidaqmx.Task() as task:
-                task.do_channels.add_do_chan(interlock_ID)
-                task.write(self.interlock_state, auto_start=True)
-                task.wait_until_done()
-        except Exception as ex:
-            self.add_message("----------------")
-            self.add_message(str(ex))
-            self.add_message("========")
-            self.add_message("**ERROR: Could not connect to digital output channel "+interlock_ID)
-            self.monitor = True
-            return
-
-        #check whether interlock is properly closed (i.e. if physical door interlocks are closed etc.)
-        try:
-            with nidaqmx.Task() as task:
-                task.di_channels.add_di_chan(ILmon_ID) #interlock monitor: High->interlock broken
-                value = task.read()
-                task.wait_until_done()
-            if value is True and self.interlock_state is True:
-                # door interlocks must be interrupted
-                self.interlock_state = False
-                self.add_message("========")
-                self.add_message("**ERROR: Interlock is interrupted. Are any doors open or is power cut?")
-                with nidaqmx.Task() as task:
-                    task.do_channels.add_do_chan(interlock_ID)
-                    task.write(self.interlock_state, auto_start=True)
-                    task.wait_until_done()
-                self.switch_interlock.setIcon(QIcon(QPixmap("icons/Interlock_off.gif")))
-        except Exception as ex:
-            self.add_message("----------------")
-            self.add_message(str(ex))
-            self.add_message("========")
-            self.add_message("**ERROR: Could not connect to digital input channel "+ILmon_ID)
-            self.monitor = True
-            return
+    def cancel_ramp(self):
+        self.call('cancel')
 
+    def show_progress(self, progress:dict):
+        if progress['quantity'] == 'kV':
+            self.field_kVmon.setText("{:.3f}".format(progress['value']))
+        else:
+            self.field_mAmon.setText("{:.3f}".format(progress['value']))
 
     def set_min_voltage(self):
         if self.interlock_state is True: #only do so if interlock switched on!
             # set source setting to minimal settings: 10kV, 0.1 mA
-            self.field_kVset.setText("{:.3f}".format(10.))
-            self.field_mAset.setText("{:.3f}".format(0.1))
-            self.ramp_voltage(0.1/2*10, mAset_ID)
-            self.add_message("Tube voltage set to 0.1mA")
-            self.ramp_voltage(10./50.*10, kVset_ID)
-            self.add_message("Tube voltage set to 10kV")
+            if self.call('set_min', fast=self.ramp_fast.isChecked()) is True:
+                self.field_kVset.setText("{:.3f}".format(10.))
+                self.field_mAset.setText("{:.3f}".format(0.1))
     
     def set_max_voltage(self):          
         if self.interlock_state is True: #only do so if interlock switched on!
-            # set source setting to minimal settings: 40kV, 2 mA
-            with nidaqmx.Task() as task:
-                task.ai_channels.add_ai_voltage_chan(kVmon_ID, terminal_config = TerminalConfiguration.RSE)
-                src_volt = task.read()
-                task.wait_until_done()
-            src_volt *= 5.
-            with nidaqmx.Task() as task:
-                task.ai_channels.add_ai_voltage_chan(mAmon_ID, terminal_config = TerminalConfiguration.RSE)
-                src_curr = task.read()
-                task.wait_until_done()
-            src_curr *= 0.2
+            # set source setting to maximal settings: 40kV, 2 mA, ramped up in turns (see XEnA_tube_daq.PROFILE_MAX)
+            if self.call('set_max', fast=self.ramp_fast.isChecked()) is True:
+                self.field_kVset.setText("{:.3f}".format(40.))
+                self.field_mAset.setText("{:.3f}".format(2.))
 
-            self.field_kVset.setText("{:.3f}".format(40.))
-            self.field_mAset.setText("{:.3f}".format(2.))
-            # a lot of ifs to prevent unnecessary ramping down (i.e. start from where the source currently is set)
-            if src_volt < 10.:
-                self.ramp_voltage(10./50.*10, kVset_ID)
-            if src_curr < 0.1:
-                self.ramp_voltage(0.1/2*10, mAset_ID)
-            if src_volt < 20.:
-                self.ramp_voltage(20./50.*10, kVset_ID)
-            if src_curr < 0.5:
-                self.ramp_voltage(0.5/2*10, mAset_ID)
-            if src_volt < 25.:
-                self.ramp_voltage(25./50.*10, kVset_ID)
-            if src_curr < 0.75:
-                self.ramp_voltage(0.75/2*10, mAset_ID)
-            if src_volt < 30.:
-                self.ramp_voltage(30./50.*10, kVset_ID)
-            if src_curr < 1.:
-                self.ramp_voltage(1./2*10, mAset_ID)
-            if src_volt < 35.:
-                self.ramp_voltage(35./50.*10, kVset_ID)
-            if src_curr < 1.25:
-                self.ramp_voltage(1.25/2*10, mAset_ID)
-            if src_volt < 40.:
-                self.ramp_voltage(40./50.*10, kVset_ID)
-            if src_curr < 1.5:
-                self.ramp_voltage(1.5/2*10, mAset_ID)
-            if src_curr < 2.:
-                self.ramp_voltage(2./2*10, mAset_ID)
-            self.add_message("Tube voltage set to 40kV")
-            self.add_message("Tube voltage set to 2.0mA")
-
-    
     def set_voltage(self):
-        value = float(self.field_kVset.text())
-        # ramp up voltage certain timeframe (e.g. 50s for 0-10V; 0.2V/s)
-        voltage = value/50.*10. #0V=0keV, 10V=50keV
-        if voltage < 0.:
-            voltage = 0.
-            self.field_kVset.setText("{:.3f}".format(0.))
-            self.add_message("WARNING: tube voltage cannot be negative.")
-        if voltage > 8:  #voltage limited to 40kV
-            voltage = 8.
-            self.field_kVset.setText("{:.3f}".format(40.))
-            self.add_message("WARNING: tube voltage cannot exceed 40kV.")
-
-        if self.ramp_voltage(voltage, kVset_ID) == True:
-            self.add_message("Tube voltage set to "+self.field_kVset.text()+"kV")
-            return True
-        else:
-            self.add_message("**ERROR: could not set tube voltage to "+self.field_kVset.text()+"kV")
-            return False
+        # the service limits the voltage to 0-40 kV
+        value = self.call('set_voltage', float(self.field_kVset.text()), fast=self.ramp_fast.isChecked())
+        if value is not None:
+            self.field_kVset.setText("{:.3f}".format(value))
     
     def set_current(self):
-        value = float(self.field_mAset.text())
-        # ramp up voltage certain timeframe (e.g. 50s for 0-10V; 0.2V/s)
-        current = value/2.*10. #0V=0mA; 10V=2mA
-        if current < 0.:
-            current = 0.
-            self.field_mAset.setText("{:.3f}".format(0.))
-            self.add_message("WARNING: tube current cannot be negative.")
-        if current > 10:
-            current = 10.
-            self.field_mAset.setText("{:.3f}".format(2.))
-            self.add_message("WARNING: tube voltage cannot exceed 2mA.")
-        
-        if self.ramp_voltage(current, mAset_ID) == True:
-            self.add_message("Tube current set to %s mA" % self.field_mAset.text())
-            return True
-        else:
-            self.add_message("**ERROR: could not set tube current to "+self.field_mAset.text()+"mA")
-            return False
-
-    def ramp_voltage(self, setpoint, address_set):
-        try:
-            self.monitor = False #temporarily make the monitor stop monitoring to avoid nidaq errors
-
-            if address_set == kVset_ID:
-                address_mon = kVmon_ID
-            elif address_set == mAset_ID:
-                address_mon = mAmon_ID
-
-            with nidaqmx.Task() as task:
-                task.ai_channels.add_ai_voltage_chan(address_mon, terminal_config = TerminalConfiguration.RSE)
-                current_volt = task.read()
-                task.wait_until_done()
-            
-            if setpoint <= current_volt:
-                incr = -0.2
-                rampup = False
-            else:
-                incr = 0.2
-                rampup = True
-
-            n_incr = int(np.floor((setpoint - current_volt)/incr))
-            set_voltage = (np.arange(n_incr)+1)*incr + current_volt
-            
-            src_volt_previous = 0
-            src_curr_previous = 0
-            for i in range(n_incr):
-                with nidaqmx.Task() as task:
-                    task.ao_channels.add_ao_voltage_chan(address_set)
-                    task.write(set_voltage[i], auto_start=True)
-                    task.wait_until_done()
-                with nidaqmx.Task() as task:
-                    task.ai_channels.add_ai_voltage_chan(kVmon_ID, terminal_config = TerminalConfiguration.RSE)
-                    src_volt = task.read()
-                    task.wait_until_done()
-                src_volt *= 5.
-                with nidaqmx.Task() as task:
-                    task.ai_channels.add_ai_voltage_chan(mAmon_ID, terminal_config = TerminalConfiguration.RSE)
-                    src_curr = task.read()
-                    task.wait_until_done()
-                src_curr *= 0.2
-                
-                if address_mon == kVmon_ID:
-                    self.add_message("\tRamped to "+"{:.2f}".format(src_volt) +" kV (goal: "+"{:.2f}".format(setpoint/10.*50.)+" kV)")
-                    self.field_kVmon.setText("{:.3f}".format(src_volt))                       
-                elif address_mon == mAmon_ID:
-                    self.add_message("\tRamped to "+"{:.2f}".format(src_curr) +" mA (goal: "+"{:.2f}".format(setpoint/10.*2.)+" mA)")
-                    self.field_mAmon.setText("{:.3f}".format(src_curr))
-                time.sleep(1)
-
-                # Implement some longer wait times when crossing certain voltage and current settings during ramping up
-                if rampup is True and i != 0:
-                    if address_mon == kVmon_ID: #are only ramping voltage now
-                        if src_volt_previous < 10. and src_volt >= 10.:
-                            self.waitawhile()
-                        elif src_volt_previous < 20. and src_volt >= 20.:
-                            self.waitawhile()
-                        elif src_volt_previous < 30. and src_volt >= 30.:
-                            self.waitawhile()
-                        elif src_volt_previous < 35. and src_volt >= 35.:
-                            self.waitawhile()
-                        elif src_volt_previous < 39.5 and src_volt >= 39.5:
-                            self.waitawhile()
-                    elif address_mon == mAmon_ID: #are only ramping current now
-                        if src_curr_previous < 0.1 and src_curr >= 0.1:
-                            self.waitawhile()
-                        elif src_curr_previous < 0.5 and src_curr >= 0.5:
-                            self.waitawhile()
-                        elif src_curr_previous < 1.0 and src_curr >= 1.0:
-                            self.waitawhile()
-                        elif src_curr_previous < 1.25 and src_curr >= 1.25:
-                            self.waitawhile()
-                        elif src_curr_previous < 1.5 and src_curr >= 1.5:
-                            self.waitawhile()
-                src_volt_previous = src_volt
-                src_curr_previous = src_curr
-                    
-
-            with nidaqmx.Task() as task:
-                task.ao_channels.add_ao_voltage_chan(address_set)
-                task.write(setpoint, auto_start=True)
-                task.wait_until_done()
-
-            self.monitor = True # restart monitor
-            
-            return True
-        
-        except Exception as ex:
-            self.add_message("----------------")
-            self.add_message(str(ex))
-            self.add_message("========")
-            self.monitor = True
-            return False
-
-    def waitawhile(self):
-        if self.ramp_slow.isChecked() is True:
-            waittime = 300
-        else:
-            waittime = 20
-
-        self.add_message("\t  *Stabilising source for %i seconds." % waittime)
-        time.sleep(waittime)
+        # the service limits the current to 0-2 mA
+        value = self.call('set_current', float(self.field_mAset.text()), fast=self.ramp_fast.isChecked())
+        if value is not None:
+            self.field_mAset.setText("{:.3f}".format(value))
 
     def add_message(self, text):
-        output = self.message_win.text()
-        output += text+'\n'
-        self.message_win.setText(output)
-        QCoreApplication.processEvents() #update the gui... it's slow, but the only thing that appears to works...
+        self.log.add(text)
         
     def closeEvent(self, event):
-        self.stop.set() #terminates tube_monitor
-        self.thread.join()
+        # the tube control service, and so the tube monitor, keeps running
+        if self.client is not None:
+            self.timer.stop()
+            self.client.close()
         event.accept()
 
 # def run():
@@ -503,18 +274,6 @@ class XEnA_tube_gui(QWidget):
 #     xena_tube.show()
 #     sys.exit(app.exec_())    
 
-class RunTubeGui(threading.Thread):
-    #constructor
-    def __init__(self):
-        #execute the base constructor
-        threading.Thread.__init__(self)
-    
-    def run(self):
-        app = QApplication(sys.argv)
-        self.xena_tube = XEnA_tube_gui()
-        self.xena_tube.show()
-        sys.exit(app.exec_())
-    
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     xena_tube = XEnA_tube_gui()
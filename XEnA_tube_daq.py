@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""
+NI-DAQmx side of the X-ray tube control, without any GUI.
+The TubeMonitor keeps a single hardware timed task on the tube voltage and current monitor inputs, and a persistent task
+on the interlock monitor line. The interlock line uses change detection where the DAQ device supports it, and is polled
+otherwise. An interrupted interlock switches the tube off immediately, from the monitor thread.
+All monitor samples are kept in a TubeRingBuffer, from which the tube current during any time interval (e.g. the counting
+time of a scan point) can be obtained.
+TubeOutputs keeps persistent tasks on the interlock output and set points, and TubeRamp ramps the set points along a
+ramp profile on a worker thread.
+"""
+
+# Connection layout:
+#  DAQ          tube
+# AO GND ---- DB9 pin 9
+# AO 0 ------ DB9 pin 3   # kV adj  0-10V  = 0-50kV
+# AO 1 ------ DB9 pin 6   # mA adj  0-10V  = 0-2mA
+
+# AI GND ---- J4 pin 1
+# AI 0 ------ J4 pin 2    # kV mon
+# AI 1 ------ J4 pin 3    # mA mon
+
+# DO PF2.0 (Active Drive) ------ connector J4 pin 4 # Interlock  5V
+#       nidaqmx.constants.DigitalDriveType.ACTIVE_DRIVE (= 12573)
+
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+import XEnA_sim
+if XEnA_sim.SIMULATE is True:
+    from XEnA_sim import nidaqmx
+    TerminalConfiguration = nidaqmx.constants.TerminalConfiguration
+    AcquisitionType = nidaqmx.constants.AcquisitionType
+    Signal = nidaqmx.constants.Signal
+    AnalogMultiChannelReader = nidaqmx.stream_readers.AnalogMultiChannelReader
+else:
+    import nidaqmx  # pip install nidaqmx, https://itom.bitbucket.io/plugindoc/plugins/ad-converters/niDAQmx.html
+    from nidaqmx.constants import TerminalConfiguration, AcquisitionType, Signal
+    from nidaqmx.stream_readers import AnalogMultiChannelReader
+
+kVmon_ID = "Dev1/ai0"
+mAmon_ID = "Dev1/ai4"
+kVset_ID = "Dev1/ao0"
+mAset_ID = "Dev1/ao1"
+interlock_ID = "Dev1/port2/line0"
+ILmon_ID = "Dev1/port1/line3"
+
+KV_PER_V = 50./10. # 0-10V = 0-50kV
+MA_PER_V = 2./10. # 0-10V = 0-2mA
+SCALE = {'kV': KV_PER_V, 'mA': MA_PER_V}
+SAMPLE_RATE = 1000. # Hz, sample clock of the monitor inputs
+AVERAGE_TIME = 1. # s, the monitor values are averaged over this time
+READ_TIME = 0.02 # s, samples are transferred from the DAQ to the ring buffer in blocks of this duration
+BUFFER_BLOCKS = 4 # DAQ buffer size in averaging intervals, so a late read does not lose samples
+RING_TIME = 600. # s, duration of the monitor history kept in the ring buffer
+INTERLOCK_POLL = 0.005 # s, interlock polling interval on devices without change detection
+
+RAMP_STEP = 0.2 # V, set point change per ramp step (1 kV or 0.04 mA)
+RAMP_INTERVAL = 1. # s, duration of a ramp step
+DWELL_SLOW = 300. # s, stabilisation time at the dwell points of a slow ramp
+DWELL_FAST = 20. # s, idem for a fast ramp
+# ramping up past these values the ramp pauses for the dwell time, so the source can stabilise
+DWELL_POINTS = {'kV': (10., 20., 30., 35., 39.5),
+                'mA': (0.1, 0.5, 1., 1.25, 1.5)}
+# ramp profiles: (quantity, target, up_only) steps. A step with up_only is skipped when the tube is already at or above
+#   its target, so the tube is never ramped down in between.
+PROFILE_MAX = (('kV', 10., True), ('mA', 0.1, True), ('kV', 20., True), ('mA', 0.5, True), ('kV', 25., True),
+               ('mA', 0.75, True), ('kV', 30., True), ('mA', 1., True), ('kV', 35., True), ('mA', 1.25, True),
+               ('kV', 40., True), ('mA', 1.5, True), ('mA', 2., True)) # 40 kV, 2 mA
+PROFILE_MIN = (('mA', 0.1, False), ('kV', 10., False)) # 10 kV, 0.1 mA
+PROFILE_OFF = (('kV', 0., False), ('mA', 0., False))
+
+
+def tube_off():
+    # interlock off and both set points to 0 V
+    with nidaqmx.Task() as task:
+        task.do_channels.add_do_chan(interlock_ID)
+        task.write(False, auto_start=True)
+        task.wait_until_done()
+    for address in (mAset_ID, kVset_ID):
+        with nidaqmx.Task() as task:
+            task.ao_channels.add_ao_voltage_chan(address)
+            task.write(0., auto_start=True)
+            task.wait_until_done()
+
+
+class TubeOutputs():
+    """Persistent tasks on the tube outputs: the interlock line and the kV and mA set points (in kV and mA). Thread safe."""
+    def __init__(self):
+        self.interlock_on = False
+        self.setpoint = {'kV': np.nan, 'mA': np.nan} # last written set points
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def open(self):
+        try:
+            self._tasks['interlock'] = nidaqmx.Task()
+            self._tasks['interlock'].do_channels.add_do_chan(interlock_ID)
+            self.interlock_on = bool(self._tasks['interlock'].read()) # the line keeps its state from a previous session
+            for quantity, address in (('kV', kVset_ID), ('mA', mAset_ID)):
+                self._tasks[quantity] = nidaqmx.Task()
+                self._tasks[quantity].ao_channels.add_ao_voltage_chan(address)
+            for task in self._tasks.values():
+                task.start()
+        except Exception:
+            self.close()
+            raise
+
+    def write(self, quantity:str, value:float):
+        with self._lock:
+            self._tasks[quantity].write(value/SCALE[quantity])
+            self.setpoint[quantity] = value
+
+    def set_interlock(self, on:bool):
+        with self._lock:
+            self._tasks['interlock'].write(bool(on))
+            self.interlock_on = bool(on)
+
+    def off(self):
+        # interlock off and both set points to 0 V
+        self.set_interlock(False)
+        self.write('mA', 0.)
+        self.write('kV', 0.)
+
+    def close(self):
+        for task in self._tasks.values():
+            try:
+                task.stop()
+                task.close()
+            except Exception:
+                pass
+        self._tasks = {}
+
+
+class TubeRingBuffer():
+    """Fixed size history of the tube monitor samples: time (time.time()), kV and mA. All methods are thread safe."""
+    def __init__(self, capacity:int):
+        self.capacity = int(capacity)
+        self._data = np.full((3, self.capacity), np.nan) # rows: time, kV, mA
+        self._count = 0 # number of samples appended since creation
+        self._appended = threading.Condition()
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, t, kV, mA):
+        # t, kV, mA: equally long arrays of consecutive samples
+        samples = np.array([t, kV, mA], dtype=float, ndmin=2)[:, -self.capacity:]
+        n = samples.shape[1]
+        with self._appended:
+            start = self._count % self.capacity
+            first = min(n, self.capacity-start)
+            self._data[:, start:start+first] = samples[:, :first]
+            self._data[:, :n-first] = samples[:, first:]
+            self._count += n
+            self._appended.notify_all()
+
+    @property
+    def last_time(self):
+        with self._appended:
+            if self._count == 0:
+                return -np.inf
+            return self._data[0, (self._count-1) % self.capacity]
+
+    def _segments(self):
+        # the stored samples in chronological order, as at most two views on the buffer
+        if self._count <= self.capacity:
+            return [self._data[:, :self._count]]
+        start = self._count % self.capacity
+        return [self._data[:, start:], self._data[:, :start]]
+
+    def latest(self, n:int):
+        # copy of the last n samples, as a (3, n) array
+        with self._appended:
+            return np.concatenate(self._segments(), axis=1)[:, -int(n):] if n > 0 else np.zeros((3, 0))
+
+    def window(self, tstart:float, tstop:float, margin:int=0):
+        # copy of the samples with tstart <= time <= tstop, plus margin samples on either side, as a (3, n) array
+        parts = []
+        with self._appended:
+            segments = self._segments()
+            for index, segment in enumerate(segments):
+                lo = np.searchsorted(segment[0], tstart, side='left')
+                hi = np.searchsorted(segment[0], tstop, side='right')
+                if margin > 0:
+                    # margin samples may come from the neighbouring segment, which is handled by concatenating below
+                    lo, hi = max(lo-margin, 0), min(hi+margin, segment.shape[1])
+                parts.append(segment[:, lo:hi].copy())
+        if len(parts) == 0:
+            return np.zeros((3, 0))
+        return np.concatenate(parts, axis=1)
+
+    def wait_until(self, t:float, timeout:float=None):
+        # wait until the buffer holds samples up to time t; returns False on timeout
+        with self._appended:
+            return self._appended.wait_for(lambda: self._count > 0 and self._data[0, (self._count-1) % self.capacity] >= t, timeout=timeout)
+
+    def interval(self, tstart:float, tstop:float):
+        # mean kV, mean mA and integrated current (mA*s) over exactly [tstart, tstop], linearly interpolating the
+        #   samples at the interval edges; NaN when the buffer does not cover the interval
+        samples = self.window(tstart, tstop, margin=1)
+        if samples.shape[1] < 2 or samples[0, 0] > tstart or samples[0, -1] < tstop or tstop <= tstart:
+            return np.nan, np.nan, np.nan
+        t = np.clip(samples[0], tstart, tstop)
+        values = [np.interp(t, samples[0], row) for row in samples[1:]]
+        integrals = [0.5*np.sum(np.diff(t)*(row[1:]+row[:-1])) for row in values]
+        return float(integrals[0]/(tstop-tstart)), float(integrals[1]/(tstop-tstart)), float(integrals[1])
+
+
+class TubeMonitor():
+    """Continuous monitoring of the tube voltage (kV), current (mA) and interlock state on background threads.
+        on_update(kV, mA) is called after each averaging interval, on_interlock(interrupted) on each interlock change.
+        Both are called from the monitor threads. All samples are kept in self.buffer, a TubeRingBuffer."""
+    def __init__(self, rate=SAMPLE_RATE, average=AVERAGE_TIME, on_update=None, on_interlock=None, outputs:TubeOutputs=None):
+        # outputs: used to switch the tube off on an interlock interruption, otherwise temporary tasks are used
+        self.rate = float(rate)
+        self.outputs = outputs
+        self.nsamples = max(int(round(self.rate*average)), 1)
+        self.nchunk = max(int(round(self.rate*READ_TIME)), 1)
+        self.buffer = TubeRingBuffer(int(self.rate*RING_TIME))
+        self.on_update = on_update
+        self.on_interlock = on_interlock
+        self.kV = np.nan
+        self.mA = np.nan
+        self.timestamp = 0. # time.time() of the last monitor values
+        self.interlock_open = None # True: interlock interrupted (doors open or power cut)
+        self.changedetection = False
+        self.error = None # last error of the monitor threads
+        self._ai = None
+        self._di = None
+        self._dilock = threading.Lock()
+        self._updated = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def running(self):
+        return any([thread.is_alive() for thread in self._threads])
+
+    def start(self):
+        # reserves the monitor channels for as long as the monitor runs; raises when these cannot be configured
+        try:
+            self._ai = nidaqmx.Task()
+            self._ai.ai_channels.add_ai_voltage_chan(kVmon_ID, terminal_config = TerminalConfiguration.RSE) #kV monitor
+            self._ai.ai_channels.add_ai_voltage_chan(mAmon_ID, terminal_config = TerminalConfiguration.RSE) #mA monitor
+            self._ai.timing.cfg_samp_clk_timing(self.rate, sample_mode=AcquisitionType.CONTINUOUS, samps_per_chan=BUFFER_BLOCKS*self.nsamples)
+            self._di = self._interlock_task()
+            self.interlock_open = bool(self._di.read())
+            self.changedetection = self._cfg_change_detection()
+            self._ai.start()
+        except Exception:
+            self.close()
+            raise
+
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._run_monitor, name="TubeMonitor", daemon=True)]
+        if self.changedetection is False:
+            self._threads.append(threading.Thread(target=self._run_interlock, name="TubeInterlock", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _interlock_task(self):
+        task = nidaqmx.Task()
+        task.di_channels.add_di_chan(ILmon_ID) #interlock monitor: High->interlock broken
+        return task
+
+    def _cfg_change_detection(self):
+        # the interlock task reports each edge on the monitor line; not all DAQ devices support this
+        try:
+            self._di.timing.cfg_change_detection_timing(rising_edge_chan=ILmon_ID, falling_edge_chan=ILmon_ID,
+                                                        sample_mode=AcquisitionType.CONTINUOUS)
+            self._di.register_signal_event(Signal.CHANGE_DETECTION_EVENT, self._on_change)
+            self._di.start()
+            return True
+        except Exception:
+            # start over with a plain task, which is polled
+            self._di.close()
+            self._di = self._interlock_task()
+            return False
+
+    def _on_change(self, task_handle, signal_type, callback_data):
+        try:
+            with self._dilock:
+                value = bool(self._di.read())
+            self._set_interlock(value)
+        except Exception as err:
+            self.error = err
+        return 0
+
+    def _run_interlock(self):
+        while not self._stop.wait(INTERLOCK_POLL):
+            try:
+                with self._dilock:
+                    value = bool(self._di.read())
+            except Exception as err:
+                self.error = err
+                continue
+            self._set_interlock(value)
+
+    def _set_interlock(self, value:bool):
+        if value == self.interlock_open:
+            return
+        self.interlock_open = value
+        if value is True:
+            try:
+                if self.outputs is not None:
+                    self.outputs.off()
+                else:
+                    tube_off()
+            except Exception as err:
+                self.error = err
+        if self.on_interlock is not None:
+            self.on_interlock(value)
+
+    def _run_monitor(self):
+        reader = AnalogMultiChannelReader(self._ai.in_stream)
+        chunk = np.zeros((2, self.nchunk))
+        scale = np.array([[KV_PER_V], [MA_PER_V]])
+        offsets = (np.arange(self.nchunk)-self.nchunk+1)/self.rate
+        nnew = 0 # samples since the last monitor values
+        while not self._stop.is_set():
+            try:
+                reader.read_many_sample(chunk, number_of_samples_per_channel=self.nchunk, timeout=10.*self.nsamples/self.rate)
+            except Exception as err:
+                if self._stop.is_set():
+                    break
+                self.error = err
+                self._stop.wait(self.nsamples/self.rate)
+                continue
+            # the read returns as soon as the last sample of the chunk is acquired, which sets the time of all samples
+            #   in the chunk (this does not drift, unlike counting sample clock periods)
+            kV, mA = chunk*scale
+            self.buffer.append(time.time()+offsets, kV, mA)
+            nnew += self.nchunk
+            if nnew < self.nsamples:
+                continue
+            nnew = 0
+            kV, mA = (float(value) for value in self.buffer.latest(self.nsamples)[1:].mean(axis=1))
+            with self._updated:
+                self.kV, self.mA, self.timestamp = kV, mA, time.time()
+                self._updated.notify_all()
+            if self.on_update is not None:
+                self.on_update(kV, mA)
+
+    def read(self, timeout=None):
+        # waits for the next averaging interval to end and returns its (kV, mA)
+        with self._updated:
+            timestamp = self.timestamp
+            if self._updated.wait_for(lambda: self.timestamp != timestamp or not self.running, timeout=timeout) is False:
+                raise TimeoutError("No tube monitor values within "+str(timeout)+" s.")
+            return self.kV, self.mA
+
+    def latest(self, duration:float=READ_TIME):
+        # (kV, mA) averaged over the last duration seconds, without waiting; NaN before the first samples
+        samples = self.buffer.latest(max(int(round(self.rate*duration)), 1))
+        if samples.shape[1] == 0:
+            return np.nan, np.nan
+        kV, mA = samples[1:].mean(axis=1)
+        return float(kV), float(mA)
+
+    def read_interlock(self):
+        # True if the interlock is interrupted
+        if self.changedetection is True:
+            return self.interlock_open
+        with self._dilock:
+            return bool(self._di.read())
+
+    def close(self):
+        self._stop.set()
+        for task in (self._ai, self._di):
+            if task is not None:
+                try:
+                    task.stop()
+                    task.close()
+                except Exception:
+                    pass
+        for thread in self._threads:
+            thread.join(timeout=2.)
+        with self._updated:
+            self._updated.notify_all()
+        self._ai = None
+        self._di = None
+
+
+class TubeRamp():
+    """Ramps the tube set points along a ramp profile on a worker thread (see PROFILE_MAX): each step changes the set point
+        by RAMP_STEP volts per RAMP_INTERVAL, and ramping up past one of the DWELL_POINTS pauses for the dwell time.
+        start() returns a concurrent.futures.Future, with result True when the profile completed and False when it was
+        cancelled, so a ramp can be polled (done()), waited for (result()) or awaited (asyncio.wrap_future()).
+        on_progress(dict) and on_message(str) are called from the worker thread."""
+    def __init__(self, monitor:TubeMonitor, outputs:TubeOutputs, on_progress=None, on_message=None, interval=RAMP_INTERVAL):
+        self.monitor = monitor
+        self.outputs = outputs
+        self.on_progress = on_progress
+        self.on_message = on_message
+        self.interval = float(interval)
+        self._cancel = threading.Event()
+        self._thread = None
+        self._future = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, profile, dwell:float=DWELL_SLOW):
+        if self.running:
+            raise RuntimeError("A tube ramp is already running.")
+        for quantity, target, up_only in profile:
+            if quantity not in SCALE:
+                raise ValueError(f"Unknown ramp quantity {quantity}, use 'kV' or 'mA'.")
+        self._cancel.clear()
+        self._future = Future()
+        self._future.set_running_or_notify_cancel()
+        self._thread = threading.Thread(target=self._run, args=(tuple(profile), float(dwell), self._future), name="TubeRamp", daemon=True)
+        self._thread.start()
+        return self._future
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout:float=None):
+        # result of the last ramp: True when completed, False when cancelled
+        if self._future is None:
+            return True
+        return self._future.result(timeout)
+
+    def _message(self, text):
+        if self.on_message is not None:
+            self.on_message(text)
+
+    def _sleep(self, duration):
+        # False when the ramp is cancelled; an interrupted interlock ends the ramp with an error
+        if self._cancel.wait(duration):
+            return False
+        if self.monitor.interlock_open is True:
+            raise RuntimeError("**ERROR: Interlock is interrupted, ramp stopped.")
+        return True
+
+    def _run(self, profile, dwell, future):
+        try:
+            for index, step in enumerate(profile):
+                if self._ramp(index, len(profile), *step, dwell) is False:
+                    self._message("Ramp cancelled.")
+                    future.set_result(False)
+                    return
+            future.set_result(True)
+        except Exception as err:
+            future.set_exception(err)
+
+    def _ramp(self, index, nsteps, quantity, target, up_only, dwell):
+        row = ('kV', 'mA').index(quantity)
+        current = self.monitor.latest()[row]
+        if np.isnan(current):
+            raise RuntimeError("**ERROR: no tube monitor values, cannot ramp.")
+        if up_only is True and current >= target:
+            return True
+        incr = RAMP_STEP*SCALE[quantity]*(1. if target > current else -1.)
+        nincr = int(np.floor((target-current)/incr))
+        previous = current
+        for i in range(nincr):
+            self.outputs.write(quantity, current+(i+1)*incr)
+            if self._sleep(self.interval) is False:
+                return False
+            value = self.monitor.latest()[row]
+            self._message("\tRamped to "+"{:.2f}".format(value)+" "+quantity+" (goal: "+"{:.2f}".format(target)+" "+quantity+")")
+            if self.on_progress is not None:
+                self.on_progress({'step': index, 'nsteps': nsteps, 'quantity': quantity, 'value': value, 'target': target,
+                                  'fraction': (i+1)/nincr})
+            # give the source time to stabilise when ramping up past a dwell point
+            if incr > 0 and i != 0 and any([previous < point <= value for point in DWELL_POINTS[quantity]]):
+                self._message("\t  *Stabilising source for %i seconds." % dwell)
+                if self._sleep(dwell) is False:
+                    return False
+            previous = value
+        self.outputs.write(quantity, target)
+        return True
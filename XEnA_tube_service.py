@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Headless X-ray tube control service. The TubeController holds the tube logic (interlock, monitor, ramps and message log)
+without any GUI, and runs in its own process:
+    python XEnA_tube_service.py
+Clients (the tube control window, XEnA_control) connect through a XEnA_tube_client.TubeClient on a local socket, so the tube
+stays monitored and I0 remains available when the window is closed or busy, and scans do not share a process with Qt.
+Requests and replies are length-prefixed JSON messages, and only the methods in XEnA_tube_client.API can be requested.
+The service runs until shutdown() is requested by a client.
+"""
+
+import hmac
+import logging
+import os
+import socket
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeout
+from logging.handlers import RotatingFileHandler
+import XEnA_tube_daq as Xtd
+from XEnA_tube_client import ADDRESS, API, TOKEN_FILE, _new_token, _send, _recv
+
+ACCEPT_POLL = 0.5 # s, interval at which the service checks whether it is stopped
+MESSAGE_LINES = 2000 # number of messages kept for the clients
+LOG_FILE = 'logs/tube_control.log' # all messages are stored here, relative to the working directory
+LOG_SIZE = 1000000 # bytes, size at which the log file is rotated
+LOG_COUNT = 5 # number of rotated log files kept
+
+
+class TubeController():
+    """GUI-free tube control. The methods listed in API can be called by clients of the service."""
+    API = API
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self._messages = deque(maxlen=MESSAGE_LINES)
+        self._nmessages = 0 # number of messages since start, the index of the next message
+        self._msglock = threading.Lock()
+        self._logger = logging.getLogger('XEnA.tube')
+        if len(self._logger.handlers) == 0:
+            try:
+                os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+                handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_SIZE, backupCount=LOG_COUNT, encoding='utf-8')
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                self._logger.addHandler(handler)
+            except OSError as ex:
+                print("WARNING: tube control messages are not logged to file: "+str(ex))
+            self._logger.setLevel(logging.INFO)
+            self._logger.propagate = False
+
+        # persistent tasks on the interlock output and set points, used for ramping and to switch the tube off
+        self.outputs = Xtd.TubeOutputs()
+        self.outputs.open()
+        self.interlock_on = self.outputs.interlock_on
+        self.monitor = Xtd.TubeMonitor(on_interlock=self._interlock_changed, outputs=self.outputs)
+        self.ramp = Xtd.TubeRamp(self.monitor, self.outputs, on_progress=self._progress, on_message=self.message)
+        self._ramp_future = None
+        self._ramp_progress = None
+        self.message("Connecting...")
+        try:
+            self.monitor.start()
+        except Exception as ex:
+            self.message("----------------")
+            self.message(str(ex))
+            self.message("========")
+            self.message("**ERROR: Could not connect to NI-DAQmx monitor input channels.")
+            return
+        # an interrupted interlock at start also means the interlock is off
+        if self.monitor.interlock_open is True:
+            self.interlock_on = False
+        self.message("Connected.")
+
+    def message(self, text:str):
+        # thread safe: messages come from the client, monitor and ramp threads
+        self._logger.info(text)
+        with self._msglock:
+            self._messages.append(text)
+            self._nmessages += 1
+
+    def messages(self, since:int=0):
+        # (index of the next message, messages from index since onwards that are still kept)
+        with self._msglock:
+            first = self._nmessages-len(self._messages)
+            return self._nmessages, list(self._messages)[max(since-first, 0):]
+
+    def _progress(self, progress:dict):
+        self._ramp_progress = progress
+
+    def _interlock_changed(self, interrupted:bool):
+        # the tube monitor has already switched the interlock and set points off when this is called
+        if interrupted is True:
+            self.ramp.cancel()
+        if interrupted is True and self.interlock_on is True:
+            self.interlock_on = False
+            self.message("========")
+            self.message("**ERROR: Interlock is interrupted. Are any doors open or is power cut?")
+
+    def status(self):
+        return {'kV': self.monitor.kV,
+                'mA': self.monitor.mA,
+                'timestamp': self.monitor.timestamp,
+                'monitor': self.monitor.running,
+                'interlock_on': self.interlock_on,
+                'interlock_open': self.monitor.interlock_open,
+                'setpoint': dict(self.outputs.setpoint),
+                'ramp': self.ramp.running,
+                'progress': self._ramp_progress if self.ramp.running else None}
+
+    def set_interlock(self, on:bool):
+        # returns the interlock state
+        if on is True:
+            try:
+                self.outputs.set_interlock(True)
+                self.interlock_on = True
+            except Exception as ex:
+                self.message("----------------")
+                self.message(str(ex))
+                self.message("========")
+                self.message("**ERROR: Could not connect to digital output channel "+Xtd.interlock_ID)
+                return self.interlock_on
+            #check whether interlock is properly closed (i.e. if physical door interlocks are closed etc.)
+            try:
+                if self.monitor.read_interlock() is True:
+                    # door interlocks must be interrupted
+                    self.interlock_on = False
+                    self.message("========")
+                    self.message("**ERROR: Interlock is interrupted. Are any doors open or is power cut?")
+                    self.outputs.set_interlock(False)
+            except Exception as ex:
+                self.message("----------------")
+                self.message(str(ex))
+                self.message("========")
+                self.message("**ERROR: Could not connect to digital input channel "+Xtd.ILmon_ID)
+        else:
+            # the interlock is switched off once the tube is ramped down, also when that ramp fails or is cancelled
+            self.interlock_on = False
+            self.ramp.cancel()
+            try:
+                self.ramp.wait()
+            except Exception:
+                pass # reported when that ramp ended
+            future = self._start_ramp(Xtd.PROFILE_OFF, False, ["Tube ramped down."], "**ERROR: could not ramp down the tube.")
+            if future is None:
+                self._switch_off()
+            else:
+                future.add_done_callback(lambda future: self._switch_off())
+        return self.interlock_on
+
+    def _switch_off(self):
+        try:
+            self.outputs.set_interlock(False)
+        except Exception as ex:
+            self.message(str(ex))
+            self.message("**ERROR: Could not connect to digital output channel "+Xtd.interlock_ID)
+
+    def _start_ramp(self, profile, fast, messages=(), error=""):
+        # ramps on the worker thread of self.ramp; messages are added when the ramp completes, error when it fails
+        if self.ramp.running is True:
+            self.message("WARNING: a ramp is running, stop it first.")
+            return None
+        self._ramp_progress = None # until the first step of this ramp
+        self._ramp_future = self.ramp.start(profile, dwell=Xtd.DWELL_FAST if fast is True else Xtd.DWELL_SLOW)
+        def done(future):
+            try:
+                completed = future.result()
+            except Exception as ex:
+                self.message(str(ex))
+                completed = None
+            if completed is True:
+                for text in messages:
+                    self.message(text)
+            elif completed is None and error != "":
+                self.message(error)
+        self._ramp_future.add_done_callback(done)
+        return self._ramp_future
+
+    def set_voltage(self, kV:float, fast:bool=False):
+        # returns the voltage that is ramped to, which is limited to 0-40 kV; returns None when not ramping
+        kV = float(kV)
+        if kV < 0.:
+            kV = 0.
+            self.message("WARNING: tube voltage cannot be negative.")
+        if kV > 40.: #voltage limited to 40kV
+            kV = 40.
+            self.message("WARNING: tube voltage cannot exceed 40kV.")
+        if self._start_ramp([('kV', kV, False)], fast, ["Tube voltage set to {:.3f}kV".format(kV)],
+                            "**ERROR: could not set tube voltage to {:.3f}kV".format(kV)) is None:
+            return None
+        return kV
+
+    def set_current(self, mA:float, fast:bool=False):
+        # returns the current that is ramped to, which is limited to 0-2 mA; returns None when not ramping
+        mA = float(mA)
+        if mA < 0.:
+            mA = 0.
+            self.message("WARNING: tube current cannot be negative.")
+        if mA > 2.:
+            mA = 2.
+            self.message("WARNING: tube voltage cannot exceed 2mA.")
+        if self._start_ramp([('mA', mA, False)], fast, ["Tube current set to {:.3f} mA".format(mA)],
+                            "**ERROR: could not set tube current to {:.3f}mA".format(mA)) is None:
+            return None
+        return mA
+
+    def set_max(self, fast:bool=False):
+        # 40kV, 2 mA; only with the interlock switched on. Returns True when a ramp is started
+        if self.interlock_on is True:
+            return self._start_ramp(Xtd.PROFILE_MAX, fast, ["Tube voltage set to 40kV", "Tube voltage set to 2.0mA"]) is not None
+        return False
+
+    def set_min(self, fast:bool=False):
+        # 10kV, 0.1 mA; only with the interlock switched on. Returns True when a ramp is started
+        if self.interlock_on is True:
+            return self._start_ramp(Xtd.PROFILE_MIN, fast, ["Tube voltage set to 0.1mA", "Tube voltage set to 10kV"]) is not None
+        return False
+
+    def cancel(self):
+        self.ramp.cancel()
+
+    def wait_ramp(self, timeout:float=None):
+        # True when the last ramp completed, False when it was cancelled or failed, None when still running at timeout
+        if self._ramp_future is None:
+            return True
+        try:
+            return self._ramp_future.result(timeout)
+        except FutureTimeout:
+            return None
+        except Exception:
+            return False
+
+    def interval(self, tstart:float, tstop:float, timeout:float=0.):
+        # mean kV, mean mA and integrated current (mA*s) over [tstart, tstop] (time.time()), see TubeRingBuffer.interval
+        #   waits up to timeout s for the monitor samples of tstop
+        if timeout > 0:
+            self.monitor.buffer.wait_until(tstop, timeout=timeout)
+        return self.monitor.buffer.interval(tstart, tstop)
+
+    def window(self, tstart:float, tstop:float):
+        # monitor samples (time, kV, mA) within [tstart, tstop], as a (3, n) array (nested lists for the clients)
+        return self.monitor.buffer.window(tstart, tstop)
+
+    def shutdown(self):
+        self.message("Tube control service stopped.")
+        self.stopped.set()
+
+    def close(self):
+        self.ramp.cancel()
+        self.monitor.close()
+        self.outputs.close()
+
+
+def _handle(controller:TubeController, sock, token:str):
+    # requests are {'token', 'method', 'args', 'kwargs'}, replies {'status': 'ok', 'result'} or {'status': 'error', 'message'}
+    with sock:
+        while not controller.stopped.is_set():
+            try:
+                request = _recv(sock)
+            except (EOFError, OSError, ValueError):
+                break
+            if not isinstance(request, dict) or not hmac.compare_digest(str(request.get('token', '')), token):
+                # the connection is closed, so a client without the token cannot try any further
+                try:
+                    _send(sock, {'status': 'error', 'message': "PermissionError: invalid tube control service token"})
+                except OSError:
+                    pass
+                break
+            try:
+                method, args, kwargs = request['method'], request.get('args', []), request.get('kwargs', {})
+                if method not in TubeController.API:
+                    raise AttributeError(f"Unknown tube control request {method}")
+                if not isinstance(args, list) or not isinstance(kwargs, dict):
+                    raise TypeError("Tube control request arguments should be a list and a dict")
+                reply = {'status': 'ok', 'result': getattr(controller, method)(*args, **kwargs)}
+            except Exception as err:
+                reply = {'status': 'error', 'message': f"{type(err).__name__}: {err}"}
+            try:
+                _send(sock, reply)
+            except (EOFError, OSError):
+                break
+
+def serve(address=ADDRESS, token_file=TOKEN_FILE):
+    controller = TubeController()
+    server = socket.create_server(address)
+    server.settimeout(ACCEPT_POLL)
+    print(f"Tube control service listening on {address}")
+    try:
+        # a new token at every start, written once the address is ours and before any connection is accepted
+        token = _new_token(token_file)
+        while not controller.stopped.is_set():
+            try:
+                sock, _ = server.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(None)
+            threading.Thread(target=_handle, args=(controller, sock, token), daemon=True).start()
+    finally:
+        controller.close()
+        server.close()
+        try:
+            os.remove(token_file)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Regression benchmark for XEnA_scan_writer.ScanWriter.store():
+the time spent storing a single scan point should not grow with the number of points already stored.
+    Usage: python benchmarks/bench_scan_writer.py [--npoints 2000] [--nchan 4096] [--ndet 1]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import XEnA_scan_writer as Xsw
+
+
+def run(npoints, nchan, ndet, block, flush_interval):
+    rng = np.random.default_rng(0)
+    spectra = rng.poisson(20., size=(16, ndet, nchan)).astype(np.int32) # a few spectra to cycle through
+    pointtime = np.zeros(npoints)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = Xsw.ScanWriter(os.path.join(tmpdir, 'bench.h5'), 'bench', npoints, 'mot1', 'mot2', flush_interval=flush_interval)
+        for i in range(npoints):
+            data = {'motXpos': float(i),
+                    'motYpos': 0.,
+                    'I0' : 1.,
+                    'realtime_s' : 1.,
+                    'active_detectors' : [f'det{n}' for n in range(ndet)],
+                    'spe' : list(spectra[i % spectra.shape[0]]),
+                    'icr' : [1000.]*ndet,
+                    'ocr' : [900.]*ndet,
+                    'realtime' : [1.]*ndet,
+                    'events' : [1000.]*ndet}
+            t0 = time.perf_counter()
+            writer.store(data)
+            pointtime[i] = time.perf_counter()-t0
+        writer.close()
+
+    nblock = npoints // block
+    blocktime = pointtime[:nblock*block].reshape(nblock, block).mean(axis=1)
+    print(f"ScanWriter.store(): {npoints} points, {nchan} channels, {ndet} detector(s)")
+    print("    "+"points".center(20)+"ms/point".center(20))
+    for n, t in enumerate(blocktime):
+        print("    "+f"{n*block}-{(n+1)*block-1}".center(20)+f"{t*1e3:.3f}".center(20))
+    return blocktime
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--npoints', type=int, default=2000)
+    parser.add_argument('--nchan', type=int, default=4096)
+    parser.add_argument('--ndet', type=int, default=1)
+    parser.add_argument('--block', type=int, default=200, help="number of points averaged per reported value")
+    parser.add_argument('--flush', type=int, default=Xsw.FLUSH_INTERVAL, help="flush interval of the scan file")
+    parser.add_argument('--tolerance', type=float, default=2., help="maximal allowed ratio of the last over the first block")
+    args = parser.parse_args()
+
+    blocktime = run(args.npoints, args.nchan, args.ndet, args.block, args.flush)
+    ratio = blocktime[-1]/blocktime[0]
+    print(f"\n    last/first block: {ratio:.2f} (tolerance {args.tolerance:.2f})")
+    if ratio > args.tolerance:
+        print("**ERROR: per point store time grows with scan length.")
+        sys.exit(1)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Scan throughput benchmark: runs count, ascan, dscan and mesh of XEnA_control on the simulated hardware (XEnA_sim),
+with modelled controller latency and stage velocity, for a range of spectrum lengths and numbers of detectors.
+For each scan the throughput (points/s), the dead time per point (wall time minus counting time) and the size of the
+scan files are reported. The results can be saved as JSON and compared to a previously saved baseline.
+    Usage: python benchmarks/bench_scans.py [--scans count ascan dscan mesh] [--nchan 256 4096 8192] [--ndet 1 2]
+                                            [--npoints 25] [--time 0.01] [--save results.json] [--baseline results.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+os.environ['XENA_SIMULATE'] = '1' # before the XEnA modules are imported
+BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, BASEDIR)
+import XEnA_sim
+import XEnA_pi_interface as Xpi
+import XEnA_pndet_interface as Xpn
+import XEnA_control as Xc
+
+SCANS = ('count', 'ascan', 'dscan', 'mesh')
+MOTOR = ('cryy', 'cryz') # stages scanned by the benchmark (fast axis, slow axis of the mesh)
+
+
+def _stagefile(tmpdir, velocity):
+    # the benchmark works on a copy of the stage dictionary, so the positions in lib/stages.json are never changed
+    with open(os.path.join(BASEDIR, 'lib', 'stages.json'), encoding='utf-8') as file:
+        stages = json.load(file)
+    for stage in stages:
+        stage['referenced'] = False # no homing and return moves at start, which would still be running during the first scan
+        if stage['velocity'] > 0:
+            stage['velocity'] = velocity
+    os.makedirs(os.path.join(tmpdir, 'lib'))
+    with open(os.path.join(tmpdir, 'lib', 'stages.json'), 'w', encoding='utf-8') as file:
+        json.dump(stages, file)
+
+def _run_scan(scan, npoints, step, counttime):
+    # returns the number of points acquired
+    fast, slow = (Xc._stage_by_name(uname) for uname in MOTOR)
+    if scan == 'count':
+        for i in range(npoints):
+            Xc.count(counttime)
+        return npoints
+    if scan == 'ascan':
+        start = Xpi.XEnA_qpos(fast)
+        Xc.ascan(fast, start, start+step*(npoints-1), npoints-1, counttime)
+        return npoints
+    if scan == 'dscan':
+        Xc.dscan(fast, 0., step*(npoints-1), npoints-1, counttime)
+        return npoints
+    if scan == 'mesh':
+        nstep = max(int(round(npoints**0.5))-1, 1)
+        start1, start2 = Xpi.XEnA_qpos_all([slow, fast])
+        Xc.mesh(slow, start1, start1+step*nstep, nstep, fast, start2, start2+step*nstep, nstep, counttime)
+        return (nstep+1)**2
+    raise ValueError(f"Unknown scan {scan}")
+
+def _h5bytes(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files if name.endswith('.h5'))
+    return size
+
+def _output(verbose):
+    # the scan commands print every step, which is only shown on request
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+def run(scans, nchans, ndets, npoints, counttime, step, verbose=False):
+    results = []
+    for ndet in ndets:
+        with _output(verbose):
+            Xc._detectors = [Xpn.PNDet(channel=n) for n in range(ndet)]
+        for nchan in nchans:
+            for det in Xc._detectors:
+                det.nchan = nchan
+            for scan in scans:
+                with _output(verbose):
+                    Xc.newsession(f"{scan}_{nchan}_{ndet}")
+                    t0 = time.perf_counter()
+                    npts = _run_scan(scan, npoints, step, counttime)
+                    elapsed = time.perf_counter()-t0
+                result = {'scan': scan, 'nchan': nchan, 'ndet': ndet, 'npoints': npts, 'time_s': elapsed,
+                          'points_per_s': npts/elapsed, 'deadtime_ms': (elapsed/npts-counttime)*1e3,
+                          'h5_bytes': _h5bytes(Xc.general.savedir)}
+                print("    "+scan.center(10)+f"{nchan}".center(10)+f"{ndet}".center(6)+f"{npts}".center(8)+
+                      f"{result['points_per_s']:.2f}".center(14)+f"{result['deadtime_ms']:.2f}".center(16)+
+                      f"{result['h5_bytes']/1024:.1f}".center(14))
+                results.append(result)
+        if Xc._acqgroup is not None: # stop the acquisition threads of these detectors
+            Xc._acqgroup.close()
+            Xc._acqgroup = None
+    return results
+
+def compare(results, baseline, tolerance, slack):
+    # a case regresses when its dead time per point exceeds the baseline by more than tolerance (relative) plus slack (ms)
+    reference = {(r['scan'], r['nchan'], r['ndet']): r for r in baseline['results']}
+    regressions = []
+    print("\n    Comparison to baseline (dead time per point, ms):")
+    for result in results:
+        key = (result['scan'], result['nchan'], result['ndet'])
+        if key not in reference:
+            continue
+        base = reference[key]['deadtime_ms']
+        limit = base*(1.+tolerance)+slack
+        flag = ''
+        if result['deadtime_ms'] > limit:
+            flag = 'REGRESSION'
+            regressions.append(key)
+        print("    "+key[0].center(10)+f"{key[1]}".center(10)+f"{key[2]}".center(6)+f"{base:.2f}".center(12)+
+              f"{result['deadtime_ms']:.2f}".center(12)+flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scans', nargs='+', choices=SCANS, default=list(SCANS))
+    parser.add_argument('--nchan', type=int, nargs='+', default=[256, 1024, 4096, 8192])
+    parser.add_argument('--ndet', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--npoints', type=int, default=25, help="points per scan (a mesh uses the nearest square)")
+    parser.add_argument('--time', type=float, default=0.01, help="counting time per point (s)")
+    parser.add_argument('--step', type=float, default=0.01, help="step size of the scanned stages (mm)")
+    parser.add_argument('--latency', type=float, default=XEnA_sim.CONFIG['latency'], help="simulated duration of each controller/DPP call (s)")
+    parser.add_argument('--velocity', type=float, default=1.5, help="simulated stage velocity (mm/s)")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare the results to this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative increase of the dead time per point")
+    parser.add_argument('--slack', type=float, default=1., help="allowed absolute increase of the dead time per point (ms)")
+    parser.add_argument('--verbose', action='store_true', help="show the output of the scan commands")
+    args = parser.parse_args()
+
+    XEnA_sim.CONFIG['latency'] = args.latency
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _stagefile(tmpdir, args.velocity)
+        os.chdir(tmpdir) # stage positions are stored relative to the working directory (lib/stages.json)
+        try:
+            with _output(args.verbose):
+                Xc._init(basedir=tmpdir.replace('\\', '/')+'/data/', tubegui=False, tube=False, stream=False)
+            print(f"Scan benchmark: {args.time} s/point, latency {args.latency*1e3:.1f} ms, velocity {args.velocity} mm/s")
+            print("    "+"scan".center(10)+"nchan".center(10)+"ndet".center(6)+"points".center(8)+
+                  "points/s".center(14)+"dead ms/point".center(16)+"h5 kB".center(14))
+            results = run(args.scans, args.nchan, args.ndet, args.npoints, args.time, args.step, args.verbose)
+            with _output(args.verbose):
+                Xpi.XEnA_close(Xc._stages)
+                Xc._detectors = []
+        finally:
+            os.chdir(workdir)
+
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'settings': {key: value for key, value in vars(args).items() if key not in ('save', 'baseline', 'verbose')},
+              'results': results}
+    if args.save is not None:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"\n    Results saved to {args.save}")
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance, args.slack):
+            print("**ERROR: scan dead time increased compared to the baseline.")
+            sys.exit(1)